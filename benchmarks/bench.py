@@ -0,0 +1,211 @@
+#! /usr/bin/env python
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Micro-benchmarks for config parsing, inheritance and Env expansion.
+
+    python benchmarks/bench.py                      # print a table
+    python benchmarks/bench.py --json > base.json   # save a baseline
+    python benchmarks/bench.py --compare base.json  # fail on regressions
+    python benchmarks/bench.py -k parse             # only matching names
+"""
+
+from __future__ import print_function
+
+import argparse
+from io import StringIO
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.synthetic import hubblerc  # noqa: E402
+
+from hubble import config  # noqa: E402
+from hubble.shell import Env, get_environments  # noqa: E402
+
+clock = getattr(time, 'perf_counter', time.time)
+
+
+def parse(text):
+    fd = StringIO(text)
+    fd.name = 'synthetic.hubblerc'
+    return config.parse_configs([fd], default_section='hubble')
+
+
+def bench_parse(sections):
+    text = hubblerc(sections=sections)
+    return lambda: parse(text)
+
+
+def bench_read_compiled(sections):
+    """ A warm start from the compiled config cache """
+    tmp = tempfile.mkdtemp()
+    path = os.path.join(tmp, 'hubblerc')
+    with open(path, 'w') as fd:
+        fd.write(hubblerc(sections=sections))
+    os.environ['HUBBLE_CACHE_DIR'] = os.path.join(tmp, 'cache')
+    config.read_configs([path], default_section='hubble')
+    CLEANUP.append(tmp)
+    return lambda: config.read_configs([path], default_section='hubble')
+
+
+def bench_items(depth):
+    conf = parse(hubblerc(sections=1000, depth=depth))
+    return lambda: conf.items('region-999')
+
+
+def bench_get_environments(meta):
+    conf = parse(hubblerc(sections=max(meta, 10), meta=meta))
+    args = argparse.Namespace(env='all')
+    return lambda: get_environments(args, 'all', conf)
+
+
+def bench_select(sections):
+    """ Build the section index and pick 200 sections with a pattern """
+    conf = parse(hubblerc(sections=sections))
+    return lambda: config.SectionIndex.build(conf).select('region-[12]??')
+
+
+def bench_eval(refs):
+    conf = parse(hubblerc(sections=1, refs=refs, options=refs))
+    items = dict(conf.items('region-0'))
+
+    def run():
+        env = Env()
+        env.add({'section': 'region-0'}, 'region-0')
+        env.add(items, 'region-0')
+        return env.eval()
+    return run
+
+
+BENCHMARKS = [
+    ('parse_configs/sections-10', bench_parse, 10),
+    ('parse_configs/sections-1000', bench_parse, 1000),
+    ('parse_configs/sections-10000', bench_parse, 10000),
+    ('read_configs/compiled-10000', bench_read_compiled, 10000),
+    ('items/depth-1', bench_items, 1),
+    ('items/depth-5', bench_items, 5),
+    ('items/depth-10', bench_items, 10),
+    ('get_environments/meta-1', bench_get_environments, 1),
+    ('get_environments/meta-50', bench_get_environments, 50),
+    ('get_environments/meta-200', bench_get_environments, 200),
+    ('select/200-of-5000', bench_select, 5000),
+    ('Env.eval/refs-10', bench_eval, 10),
+    ('Env.eval/refs-100', bench_eval, 100),
+]
+# Temp directories to remove once we are done
+CLEANUP = []
+
+
+def measure(func, repeat, min_time=0.2):
+    """
+    Return (median, best) seconds per call over 'repeat' rounds. Each
+    round calls 'func' enough times to take at least 'min_time' / repeat
+    """
+    start = clock()
+    func()
+    number = max(1, int(min_time / repeat / max(clock() - start, 1e-9)))
+    rounds = []
+    for _ in range(repeat):
+        start = clock()
+        for _ in range(number):
+            func()
+        rounds.append((clock() - start) / number)
+    rounds.sort()
+    return rounds[len(rounds) // 2], rounds[0]
+
+
+def run(pattern, repeat):
+    results = {}
+    for name, setup, scale in BENCHMARKS:
+        if pattern and pattern not in name:
+            continue
+        median, best = measure(setup(scale), repeat)
+        results[name] = {'median': median, 'best': best}
+    return results
+
+
+def human(seconds):
+    for unit, scale in (('s', 1), ('ms', 1e-3), ('us', 1e-6)):
+        if seconds >= scale:
+            return '%.2f%s' % (seconds / scale, unit)
+    return '%.0fns' % (seconds / 1e-9)
+
+
+def compare(results, baseline, tolerance):
+    """ Print the change against the baseline, return True on regression """
+    regressed = False
+    width = max(len(name) for name in results)
+    for name in sorted(results):
+        if name not in baseline['results']:
+            continue
+        old = baseline['results'][name]['median']
+        new = results[name]['median']
+        change = (new - old) / old * 100
+        flag = ''
+        if change > tolerance:
+            flag = '  REGRESSION'
+            regressed = True
+        print('%-*s %10s -> %10s %+7.1f%%%s'
+              % (width, name, human(old), human(new), change, flag))
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('-k', dest='pattern',
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument('--repeat', type=int, default=5,
+                        help="rounds per benchmark, the median is reported")
+    parser.add_argument('--json', action='store_true',
+                        help="print the results as JSON")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="compare against a saved --json baseline")
+    parser.add_argument('--tolerance', type=float, default=10.0,
+                        help="percent slower than the baseline to allow")
+    args = parser.parse_args()
+
+    try:
+        results = run(args.pattern, args.repeat)
+    finally:
+        for path in CLEANUP:
+            shutil.rmtree(path)
+
+    if args.json:
+        json.dump({'python': platform.python_version(),
+                   'results': results}, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return 0
+    if args.compare:
+        with open(args.compare) as fd:
+            baseline = json.load(fd)
+        return 1 if compare(results, baseline, args.tolerance) else 0
+
+    width = max(len(name) for name in results)
+    for name in sorted(results):
+        print('%-*s %10s (best %s)' % (width, name,
+                                       human(results[name]['median']),
+                                       human(results[name]['best'])))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
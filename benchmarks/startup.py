@@ -0,0 +1,93 @@
+#! /usr/bin/env python
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Startup time budget check for the hubble entry point.
+
+Imports the entry point module with 'python -X importtime' several times
+and fails if the median cumulative import time is over budget, or if any
+of the modules hubble only loads on demand were imported.
+
+    python benchmarks/startup.py --budget 60 --runs 10
+"""
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+
+# Modules that must only be imported once they are actually needed
+LAZY = ['keyring', 'concurrent.futures', 'tempfile', 'json', 'six',
+        'backports.configparser', 'hubble.output', 'hubble.scheduler']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def python(args):
+    environ = dict(os.environ, PYTHONPATH=ROOT)
+    p = subprocess.Popen([sys.executable] + args, env=environ,
+                         stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    if p.returncode != 0:
+        raise RuntimeError(err.decode('utf-8'))
+    return out.decode('utf-8'), err.decode('utf-8')
+
+
+def import_time(module):
+    """ Return the cumulative time in ms it took to import 'module' """
+    _, err = python(['-X', 'importtime', '-c', 'import %s' % module])
+    for line in err.splitlines():
+        fields = [f.strip() for f in line.split('|')]
+        if len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1000.0
+    raise RuntimeError("no import time reported for '%s'" % module)
+
+
+def eager_imports(module):
+    """ Return the modules from LAZY that importing 'module' imports """
+    out, _ = python(['-c', 'import sys, %s; print("\\n".join(sys.modules))'
+                     % module])
+    return sorted(set(LAZY) & set(out.split()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--module', default='hubble.shell',
+                        help="the entry point module (default hubble.shell)")
+    parser.add_argument('--budget', type=float, default=75.0,
+                        help="the most milliseconds the import may take")
+    parser.add_argument('--runs', type=int, default=10,
+                        help="how many times to import the module")
+    args = parser.parse_args()
+
+    times = sorted(import_time(args.module) for _ in range(args.runs))
+    median = times[len(times) // 2]
+    print("%s: median %.1fms, min %.1fms, max %.1fms (budget %.1fms)"
+          % (args.module, median, times[0], times[-1], args.budget))
+
+    failed = False
+    if median > args.budget:
+        print("-- FAIL: import time is over budget")
+        failed = True
+    eager = eager_imports(args.module)
+    if eager:
+        print("-- FAIL: imported on startup: %s" % ", ".join(eager))
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,65 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Generates synthetic .hubblerc files for the benchmarks. The output is
+deterministic so results can be compared between runs.
+"""
+
+
+def hubblerc(sections=10, depth=1, meta=1, refs=1, options=10):
+    """
+    Return the text of a .hubblerc with 'sections' region sections.
+
+    Every region inherits from a chain of 'depth' parent sections, each
+    region has 'options' variables and 'refs' of them reference other
+    variables with ${...}. A meta section named [all] lists the first
+    'meta' regions.
+    """
+    lines = ['[hubble]',
+             'OS_AUTH_URL=https://identity.example.com/v2.0/',
+             'OS_USERNAME=user',
+             'OS_TENANT_NAME=123456',
+             'cmd=/bin/true',
+             '']
+
+    # The chain of parents every region inherits from
+    for level in range(depth):
+        lines.append('[parent-%d]' % level)
+        if level + 1 < depth:
+            lines.append('%%inherit=parent-%d' % (level + 1))
+        lines.append('LEVEL_%d=level-%d' % (level, level))
+        lines.append('OS_USERNAME=user-%d' % level)
+        lines.append('')
+
+    for region in range(sections):
+        lines.append('[region-%d]' % region)
+        if depth:
+            lines.append('%inherit=parent-0')
+        lines.append('OS_REGION_NAME=REGION%d' % region)
+        for option in range(options):
+            if option < refs:
+                # Reference the previous option so expansion has to chain
+                value = '${OS_REGION_NAME}-${OPTION_%d}' % (option - 1) \
+                    if option else '${OS_AUTH_URL}${section}'
+            else:
+                value = 'value-%d-%d' % (region, option)
+            lines.append('OPTION_%d=%s' % (option, value))
+        lines.append('')
+
+    members = ["'region-%d'" % region for region in range(min(meta,
+                                                              sections))]
+    lines.append('[all]')
+    lines.append('meta=[%s]' % ', '.join(members))
+    lines.append('')
+    return '\n'.join(lines)
@@ -0,0 +1,30 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from hubble.resolver import Resolver  # noqa: F401
+
+# The asyncio engine is loaded the first time it is used, which needs
+# python 3.7 or later both for the engine and for lazy attributes
+LAZY = {
+    'Result': 'hubble.engine',
+    'run_async': 'hubble.engine',
+    'stream_async': 'hubble.engine',
+}
+
+
+def __getattr__(name):
+    if name in LAZY:
+        import importlib
+        return getattr(importlib.import_module(LAZY[name]), name)
+    raise AttributeError("module 'hubble' has no attribute '%s'" % name)
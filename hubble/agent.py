@@ -0,0 +1,355 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+hubble-agent keeps the parsed config, the expanded environments and the
+keyring credentials in memory and hands them to hubble over a Unix socket
+only the current user can connect to. hubble runs the opt-cmd and env-cmd
+of the environments itself.
+
+Each request and response is a single line of JSON.
+"""
+
+from __future__ import print_function
+
+from argparse import ArgumentParser, Namespace, RawDescriptionHelpFormatter
+from configparser import NoSectionError
+import errno
+import os
+import signal
+from subprocess import CalledProcessError
+import sys
+
+from hubble import keys
+from hubble.cache import private_dir, runtime_dir
+from hubble.config import string_types
+
+# The most configs and resolved environments the agent keeps around
+MAX_CACHED = 256
+# How long hubble tries to hand the agent a request before resolving
+# without it. Once the agent has the request hubble waits for the answer
+CONNECT_TIMEOUT = 2
+# How long the agent waits for a client to send its request
+REQUEST_TIMEOUT = 2
+
+
+def socket_path():
+    """
+    Return where the agent listens, HUBBLE_AGENT_SOCK if set. Like the
+    keyring session cache this lives in the users runtime directory
+    """
+    path = os.environ.get('HUBBLE_AGENT_SOCK')
+    if path:
+        return path
+    path = runtime_dir()
+    return None if path is None else os.path.join(path, 'agent.sock')
+
+
+def connect(path, timeout=CONNECT_TIMEOUT):
+    """
+    Return a socket connected to the agent or None if none is running.
+    Anything done with the socket fails if it takes longer than 'timeout'
+    """
+    import socket
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except (IOError, OSError):
+        sock.close()
+        return None
+    return sock
+
+
+def request(payload):
+    """
+    Send 'payload' to the agent and return the response, or None if no
+    agent is running or it went away before answering
+    """
+    if os.environ.get('HUBBLE_NO_AGENT'):
+        return None
+    path = socket_path()
+    if path is None or not os.path.exists(path):
+        return None
+    if not private_dir(os.path.dirname(path)):
+        return None
+    sock = connect(path, CONNECT_TIMEOUT)
+    if sock is None:
+        return None
+    import json
+    line = exchange(sock, json.dumps(payload).encode('utf-8') + b'\n')
+    try:
+        return json.loads(line.decode('utf-8'))
+    except ValueError:
+        return None
+
+
+def exchange(sock, data):
+    """
+    Send the request to the agent and return the line it answers with,
+    or b'' if it won't take the request or went away
+    """
+    try:
+        sock.sendall(data)
+        # The agent has the request, resolving it again ourselves
+        # would only repeat what it is doing
+        sock.settimeout(None)
+        return sock.makefile('rb').readline()
+    except (IOError, OSError):
+        # Including a timeout, an agent that won't listen is no agent
+        return b''
+    finally:
+        sock.close()
+
+
+def resolve(args, choice, files=None):
+    """
+    Ask a running agent for the environments of 'choice' and return
+    them as a list of Env(), or None if there is no agent to ask
+    """
+    # The agent can only read configs it can find on disk
+    if files and not all(isinstance(f, string_types) for f in files):
+        return None
+    response = request({
+        'op': 'resolve',
+        'choice': choice,
+        'args': vars(args),
+        'files': [os.path.abspath(f) for f in files] if files else None,
+        'environ': dict(os.environ),
+        'cwd': os.getcwd(),
+    })
+    if response is None:
+        return None
+    if 'missing' in response:
+        raise NoSectionError(response['missing'])
+    if 'error' in response:
+        raise RuntimeError(response['error'])
+    return [load_env(env) for env in response['environments']]
+
+
+def flush():
+    """ Tell a running agent to forget everything it has cached """
+    return request({'op': 'flush'}) is not None
+
+
+def dump_env(env):
+    return [[key, pair.value, pair.section, pair.export]
+            for key, pair in env.items()]
+
+
+def load_env(items):
+    from hubble.shell import Env
+    env = Env()
+    for key, value, section, export in items:
+        env.set(key, value, section, export)
+    return env
+
+
+class Agent(object):
+    """ Answers resolve requests from hubble, one at a time """
+    def __init__(self, path):
+        self.path = path
+        # (config, generation) by the list of config files
+        self.configs = {}
+        # Resolved environments by (generation, choice, args)
+        self.environments = {}
+        self.generation = 0
+        self.running = False
+
+    def config(self, files):
+        """ Return the config for 'files', parsing it again if it changed """
+        from hubble.config import default_files, fresh, read_configs
+        key = tuple(os.path.abspath(f) for f in files or default_files())
+        cached = self.configs.get(key)
+        ok = False
+        if cached is not None:
+            ok, touched = fresh(cached[0].sources)
+            if ok and not touched:
+                return cached
+
+        # Reading it again is cheap when only the mtimes changed, the
+        # compiled cache hands back the same config with the new mtimes
+        conf = read_configs(files=list(key), default_section='hubble')
+        if conf.get_error():
+            raise RuntimeError(conf.get_error())
+        if len(self.configs) > MAX_CACHED:
+            self.configs.clear()
+        if ok:
+            generation = cached[1]
+        else:
+            self.generation += 1
+            generation = self.generation
+        self.configs[key] = (conf, generation)
+        return conf, generation
+
+    def resolve(self, req):
+        """
+        Expand the environments in the callers environ and cwd. Their
+        opt-cmd and env-cmd are left for hubble to run, so a slow command
+        doesn't keep the agent from answering anyone else
+        """
+        import json
+        from hubble.shell import expand_environments
+        environ, cwd = os.environ.copy(), os.getcwd()
+        os.environ.clear()
+        os.environ.update(req['environ'])
+        try:
+            os.chdir(req['cwd'])
+            conf, generation = self.config(req['files'])
+            args = Namespace(**req['args'])
+            key = (generation, req['choice'],
+                   json.dumps(req['args'], sort_keys=True))
+            envs = self.environments.get(key)
+            if envs is None or getattr(args, 'refresh', False):
+                envs = expand_environments(args, req['choice'], conf)
+                if len(self.environments) > MAX_CACHED:
+                    self.environments.clear()
+                self.environments[key] = envs
+            return {'environments': [dump_env(env) for env in envs]}
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            os.chdir(cwd)
+
+    def flush(self):
+        """ Forget the configs, environments and credentials """
+        self.configs.clear()
+        self.environments.clear()
+        keys.forget()
+        return {}
+
+    def handle(self, conn):
+        import json
+        if not trusted(conn):
+            return
+        # A client that never sends its request times out
+        # rather than keeping everyone else waiting
+        line = conn.makefile('rb').readline()
+        try:
+            req = json.loads(line.decode('utf-8'))
+            if req.get('op') == 'flush':
+                response = self.flush()
+            elif req.get('op') == 'stop':
+                self.running, response = False, {}
+            else:
+                response = self.resolve(req)
+        except NoSectionError as e:
+            # hubble reports a missing section as it would without us
+            response = {'error': str(e), 'missing': e.section}
+        except (RuntimeError, EnvironmentError, CalledProcessError) as e:
+            response = {'error': str(e)}
+        except Exception as e:
+            # A bad request must not take the agent down
+            response = {'error': "%s: %s" % (type(e).__name__, e)}
+        conn.sendall(json.dumps(response).encode('utf-8') + b'\n')
+
+    def serve(self, idle_timeout=0):
+        """ Answer requests until signaled or idle for 'idle_timeout' """
+        import socket
+        if not private_dir(os.path.dirname(self.path)):
+            raise RuntimeError("refusing to listen in '%s', it must belong "
+                               "to you and be private"
+                               % os.path.dirname(self.path))
+        sock = connect(self.path)
+        if sock is not None:
+            sock.close()
+            raise RuntimeError("an agent is already listening on '%s'"
+                               % self.path)
+        unlink(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o177)
+        try:
+            server.bind(self.path)
+        finally:
+            os.umask(umask)
+        server.listen(16)
+        server.settimeout(idle_timeout or None)
+        self.running = True
+        try:
+            while self.running:
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    return
+                try:
+                    conn.settimeout(REQUEST_TIMEOUT)
+                    self.handle(conn)
+                except (IOError, OSError):
+                    pass
+                finally:
+                    conn.close()
+        finally:
+            server.close()
+            unlink(self.path)
+
+
+def trusted(conn):
+    """ Return False if the peer is not the user running the agent """
+    import socket
+    if not hasattr(socket, 'SO_PEERCRED'):
+        # Only the owner can reach the socket anyway
+        return True
+    import struct
+    creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                            struct.calcsize('3i'))
+    _, uid, _ = struct.unpack('3i', creds)
+    return uid == os.getuid()
+
+
+def unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+def terminate(signum, frame):
+    sys.exit(0)
+
+
+def main(argv=None):
+    parser = ArgumentParser(formatter_class=RawDescriptionHelpFormatter,
+                            description=__doc__)
+    parser.add_argument('--socket', metavar='PATH',
+                        help="listen on PATH instead of %s" % socket_path())
+    parser.add_argument('--idle-timeout', metavar='SECONDS', type=int,
+                        default=0, help="exit after SECONDS without a "
+                        "request (default never)")
+    parser.add_argument('--stop', action='store_true',
+                        help="stop the running agent")
+    args = parser.parse_args(argv)
+
+    if args.socket:
+        os.environ['HUBBLE_AGENT_SOCK'] = args.socket
+    path = socket_path()
+    if path is None:
+        print("-- No place to put the agent socket, set XDG_RUNTIME_DIR "
+              "or pass --socket")
+        return 1
+    if args.stop:
+        if request({'op': 'stop'}) is None:
+            print("-- No agent is listening on '%s'" % path)
+            return 1
+        return 0
+    # Clean up the socket when asked to stop
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        Agent(path).serve(args.idle_timeout)
+    except RuntimeError as e:
+        print("-- %s" % str(e))
+        return 1
+    except KeyboardInterrupt:
+        pass
+    return 0
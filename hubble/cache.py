@@ -0,0 +1,113 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import errno
+import hashlib
+import os
+import pickle
+
+
+def enabled():
+    """ Caching can be turned off with HUBBLE_NO_CACHE=1 """
+    return not os.environ.get('HUBBLE_NO_CACHE')
+
+
+def cache_dir():
+    """ Return the users hubble cache directory """
+    path = os.environ.get('HUBBLE_CACHE_DIR')
+    if path:
+        return path
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(base, 'hubble')
+
+
+def runtime_dir():
+    """
+    Return the users private hubble directory on a tmpfs, for things that
+    must never touch the disk or outlive the session. Returns None if
+    there is no such place for this user
+    """
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'hubble')
+    if os.path.isdir('/dev/shm'):
+        return os.path.join('/dev/shm', 'hubble-%d' % os.getuid())
+    return None
+
+
+def digest(*parts):
+    """ Return a hex sha256 of the str or bytes passed """
+    sha = hashlib.sha256()
+    for part in parts:
+        if not isinstance(part, bytes):
+            part = part.encode('utf-8')
+        sha.update(part)
+        sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def make_dir(path):
+    """ Create the directory only the current user can access """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def private_dir(path):
+    """
+    Create the directory if needed and return True only if it belongs to
+    the current user and no one else can access it
+    """
+    try:
+        make_dir(path)
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_uid == os.getuid() and not stat.st_mode & 0o077
+
+
+def load(path):
+    """ Return the object pickled at 'path' or None """
+    if not private_dir(os.path.dirname(path)):
+        return None
+    try:
+        with open(path, 'rb') as fd:
+            return pickle.load(fd)
+    except (IOError, OSError, EOFError, ValueError, pickle.PickleError,
+            AttributeError, ImportError):
+        return None
+
+
+def save(path, obj):
+    """
+    Atomically pickle 'obj' to 'path' readable only by the current user.
+    Failing to write a cache is never fatal so errors are ignored
+    """
+    if not private_dir(os.path.dirname(path)):
+        return False
+    import tempfile
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    except (IOError, OSError):
+        return False
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(obj, file, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, path)
+        return True
+    except (IOError, OSError, pickle.PickleError):
+        os.unlink(tmp)
+        return False
@@ -12,13 +12,82 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 
+from collections import OrderedDict
+# The stdlib configparser on python 3, the backport on python 2
+from configparser import _UNSET, NoOptionError, NoSectionError, \
+    RawConfigParser
+from fnmatch import fnmatchcase
+from glob import glob
+import io
 from io import StringIO
-from itertools import chain
 import os
+import re
 
-from backports.configparser import _UNSET, \
-    NoOptionError, NoSectionError, RawConfigParser
-from six import string_types
+from hubble import cache
+
+string_types = (str, type(u''))
+
+# Bump this if the layout returned by compile_config() changes
+COMPILED_VERSION = 4
+# Reads the files matching the pattern before the file it appears in
+INCLUDE = re.compile(r'^%include(?:\s*[=:]\s*|\s+)(\S.*?)\s*$', re.M)
+# Sections that are never picked by a selector
+RESERVED_SECTIONS = ('hubble-commands',)
+
+
+def is_selector(value):
+    """ Return True if 'value' picks sections by tag or pattern """
+    return value.startswith(('@', 'glob:')) or any(c in value
+                                                   for c in '*?[')
+
+
+class SectionIndex(object):
+    """
+    The sections a selector can pick from and the sections with each tag,
+    in the order they appear in the config. It is built once per config so
+    selecting sections never has to read every section
+    """
+    def __init__(self, names, tags):
+        self.names = names
+        self.tags = tags
+
+    @classmethod
+    def build(cls, config):
+        names, tags = [], {}
+        for section in config.sections():
+            if section in RESERVED_SECTIONS:
+                continue
+            try:
+                options = config._flatten(section)
+            except (NoSectionError, RuntimeError):
+                # Broken sections can still be picked, the error is
+                # raised once the section is used
+                names.append(section)
+                continue
+            # Meta sections are selections themselves
+            if 'meta' in options:
+                continue
+            names.append(section)
+            for tag in options.get('tags', '').replace(',', ' ').split():
+                tags.setdefault(tag, []).append(section)
+        return cls(names, tags)
+
+    def select(self, selector):
+        """
+        Return the sections matching 'selector', a list of '@tag',
+        'glob:pattern' or bare pattern terms separated by commas or spaces
+        """
+        selected = []
+        for term in selector.replace(',', ' ').split():
+            if term.startswith('@'):
+                matches = self.tags.get(term[1:], [])
+            else:
+                if term.startswith('glob:'):
+                    term = term[len('glob:'):]
+                matches = [name for name in self.names
+                           if fnmatchcase(name, term)]
+            selected.extend(name for name in matches if name not in selected)
+        return selected
 
 
 class ListConfigParser(RawConfigParser):
@@ -37,29 +106,120 @@ class ListConfigParser(RawConfigParser):
 
 
 class InheritanceConfigParser(ListConfigParser):
-    def _supersections(self, section):
+    def __init__(self, *args, **kwargs):
+        # Sections inherited and flattened options, by section name
+        self._inherits = {}
+        self._flattened = {}
+        self._index = None
+        super(InheritanceConfigParser, self).__init__(*args, **kwargs)
+
+    def _invalidate(self):
+        """ Forget what we know about inheritance when the config changes """
+        self._inherits.clear()
+        self._flattened.clear()
+        self._index = None
+
+    def section_index(self):
+        """ Return the SectionIndex() of this config """
+        if self._index is None:
+            self._index = SectionIndex.build(self)
+        return self._index
+
+    def _read(self, fp, fpname):
+        self._invalidate()
+        return super(InheritanceConfigParser, self)._read(fp, fpname)
+
+    def add_section(self, section):
+        self._invalidate()
+        return super(InheritanceConfigParser, self).add_section(section)
+
+    def set(self, section, option, value=None):
+        self._invalidate()
+        return super(InheritanceConfigParser, self).set(section, option,
+                                                        value)
+
+    def remove_option(self, section, option):
+        self._invalidate()
+        return super(InheritanceConfigParser, self).remove_option(section,
+                                                                  option)
+
+    def remove_section(self, section):
+        self._invalidate()
+        return super(InheritanceConfigParser, self).remove_section(section)
+
+    def _supersections(self, section, path=()):
+        """Return the names of every section 'section' inherits from, in
+        the order their values take precedence. Each section appears once
+        and is computed only once.
+
+        """
+        if section in path:
+            cycle = ' -> '.join(path[path.index(section):] + (section,))
+            raise RuntimeError("%%inherit cycle detected [%s]" % cycle)
+        try:
+            return self._inherits[section]
+        except KeyError:
+            pass
+
         try:
             section_names = self._sections[section]['%inherit']
             section_names = self.list_converter(section_names)
         except KeyError:
-            return []
-
-        sections = [self._sections[section] for section in section_names]
+            section_names = []
 
+        names = list(section_names)
         # nested inheritance
-        hypersections = (self._supersections(section_name) for
-                         section_name in section_names)
-
-        return chain(sections, *hypersections)
+        for name in section_names:
+            if name not in self._sections:
+                raise NoSectionError(name)
+            names.extend(self._supersections(name, path + (section,)))
+
+        # Earlier sections take precedence, so only the first one counts
+        unique = []
+        for name in names:
+            if name not in unique:
+                unique.append(name)
+        self._inherits[section] = unique
+        return unique
+
+    def _flatten(self, section):
+        """Return a single dict of the options in 'section' and all the
+        sections it inherits from, with the same key order and precedence
+        as the chain of sections would have
+
+        """
+        try:
+            return self._flattened[section]
+        except KeyError:
+            pass
+        maps = [self._sections[section]]
+        maps.extend(self._sections[name] for
+                    name in self._supersections(section))
+        flat = self._dict()
+        for mapping in reversed(maps):
+            flat.update(mapping)
+        self._flattened[section] = flat
+        return flat
+
+    def section_items(self, section):
+        """Return a dict of the options in 'section' and the sections it
+        inherits from, without the defaults every section has. The dict
+        must not be changed
+
+        """
+        if section not in self._sections:
+            raise NoSectionError(section)
+        return self._flatten(section)
 
     def _unify_values(self, section, vars):
-        '''Inject supersections into the correct position in the inheritance
-        chain.
+        '''Replace the section in the chain with the flattened section
+        that includes all the sections it inherits from.
 
         '''
         chain = super(InheritanceConfigParser, self)._unify_values(section, vars)  # noqa: E501
 
-        chain.maps[2:2] = self._supersections(section)
+        if section in self._sections:
+            chain.maps[1] = self._flatten(section)
 
         return chain
 
@@ -100,6 +260,45 @@ class ErrorConfigParser(SafeConfigParser):
         return self.msg
 
 
+class CompiledConfigParser(SafeConfigParser):
+    """
+    A read only config built from the output of compile_config(), each
+    section already includes the options it inherits
+    """
+    def __init__(self, compiled):
+        default_section, defaults, sections, errors, name, index = compiled
+        SafeConfigParser.__init__(self, default_section=default_section)
+        self.optionxform = str
+        self._defaults = defaults
+        self._sections = sections
+        self._errors = errors
+        self._index = SectionIndex(*index)
+        self.name = name
+
+    def _flatten(self, section):
+        if section in self._errors:
+            raise self._errors[section]
+        return self._sections[section]
+
+
+def compile_config(config):
+    """
+    Flatten the inheritance of every section in the config and return it
+    as a tuple that can be pickled and handed to CompiledConfigParser().
+    A section that can not be flattened keeps the error to raise when it
+    is used, so it doesn't break the sections that can
+    """
+    sections, errors = config._dict(), {}
+    for section in config.sections():
+        try:
+            sections[section] = config._flatten(section)
+        except (NoSectionError, RuntimeError) as e:
+            sections[section], errors[section] = config._dict(), e
+    index = config.section_index()
+    return (config.default_section, config._defaults, sections, errors,
+            getattr(config, 'name', None), (index.names, index.tags))
+
+
 def open_fd(file):
     """ Open the file if possible, else return None """
     if not isinstance(file, string_types):
@@ -117,17 +316,193 @@ def exists(obj):
     return os.path.exists(obj)
 
 
+def default_files():
+    """Return the config files read when none are given, in the order they
+    are read. Later files override the options of earlier ones
+
+    """
+    home = os.path.expanduser('~/.hubblerc')
+    return [home] + sorted(glob(home + '.d/*.conf')) + ['.hubblerc']
+
+
 def read_configs(files=None, default_section=None):
     """Given a list of file names, return a list of handles to succesfully
     opened files
 
     """
-    files = files or [os.path.expanduser('~/.hubblerc'), '.hubblerc']
+    files = files or default_files()
     # If non of these files exist, raise an error
     if not any([exists(rc) for rc in files]):
         return ErrorConfigParser("Unable to find config files in these"
                                  " locations [%s]" % ", ".join(files))
-    return parse_configs([open_fd(file) for file in files], default_section)
+    if not all(isinstance(f, string_types) for f in files):
+        return parse_configs([open_fd(file) for file in files],
+                             default_section)
+    if cache.enabled():
+        return read_compiled(files, default_section)
+    paths = [os.path.abspath(file) for file in files]
+    sources, config = read_files(paths, default_section, use_cache=False)
+    config.sources = sources
+    return config
+
+
+def read_source(path):
+    """ Return (source, contents) for the path, contents is None if the
+    file could not be read. The contents of a directory is its listing
+
+    """
+    try:
+        stat = os.stat(path)
+        if os.path.isdir(path):
+            contents = u'\n'.join(sorted(os.listdir(path)))
+        else:
+            with io.open(path) as fd:
+                contents = fd.read()
+    except (IOError, OSError):
+        return (path, None, None, None), None
+    return (path, stat.st_mtime, stat.st_size,
+            cache.digest(contents)), contents
+
+
+def fresh(sources):
+    """Return (fresh, touched) where fresh is True if none of the sources
+    have changed. touched is True if a file was modified but kept the
+    same contents
+
+    """
+    touched = False
+    for path, mtime, size, sha in sources:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            if sha is None:
+                continue
+            return False, False
+        if (stat.st_mtime, stat.st_size) == (mtime, size):
+            continue
+        if read_source(path)[0][3] != sha:
+            return False, False
+        touched = True
+    return True, touched
+
+
+def read_compiled(files, default_section):
+    """Return the config from the compiled cache if none of the files have
+    changed since it was written, else parse the files and cache the result
+
+    """
+    paths = [os.path.abspath(file) for file in files]
+    path = os.path.join(cache.cache_dir(), 'config-%s.pickle' % cache.digest(
+        str(COMPILED_VERSION), default_section or '', *paths))
+
+    cached = cache.load(path)
+    if cached is not None and cached[0] == COMPILED_VERSION:
+        ok, touched = fresh(cached[1])
+        sources = cached[1]
+        if ok and touched:
+            # Record the new mtimes so the next run skips the hashing
+            sources = [read_source(source[0])[0] for source in sources]
+            cache.save(path, (COMPILED_VERSION, sources, cached[2]))
+        if ok:
+            config = CompiledConfigParser(cached[2])
+            config.sources = sources
+            return config
+
+    sources, config = read_files(paths, default_section)
+    compiled = compile_config(config)
+    cache.save(path, (COMPILED_VERSION, sources, compiled))
+    config = CompiledConfigParser(compiled)
+    config.sources = sources
+    return config
+
+
+def include_paths(path, contents):
+    """ Return the absolute patterns of the %include lines in 'contents' """
+    base = os.path.dirname(path)
+    return [os.path.join(base, os.path.expanduser(pattern))
+            for pattern in INCLUDE.findall(contents)]
+
+
+def parse_fragment(path, contents, default_section):
+    """Parse a single config file on its own and return the
+    (defaults, sections, includes) it holds
+
+    """
+    # Blank the directives out so parse errors still have the right line
+    fd = StringIO(INCLUDE.sub(u'', contents))
+    fd.name = path
+    config = parse_configs([fd], default_section)
+    sections = [(name, dict(config._sections[name]))
+                for name in config.sections()]
+    return (dict(config._defaults), sections,
+            include_paths(path, contents))
+
+
+def read_fragment(path, default_section, use_cache=True):
+    """Return (source, fragment) for a single config file, fragment is None
+    if the file could not be read. Each file is cached on its own so
+    editing one file only parses that file again
+
+    """
+    cached_path = os.path.join(cache.cache_dir(), 'fragment-%s.pickle' %
+                               cache.digest(str(COMPILED_VERSION),
+                                            default_section or '', path))
+    if use_cache:
+        cached = cache.load(cached_path)
+        if cached is not None and cached[0] == COMPILED_VERSION \
+                and fresh([cached[1]]) == (True, False):
+            return cached[1], cached[2]
+
+    source, contents = read_source(path)
+    if contents is None:
+        return source, None
+    fragment = parse_fragment(path, contents, default_section)
+    if use_cache:
+        cache.save(cached_path, (COMPILED_VERSION, source, fragment))
+    return source, fragment
+
+
+def read_fragments(paths, default_section, use_cache, sources, fragments):
+    """Read each file and what it includes, the included files come first
+    so the file that includes them overrides their options
+
+    """
+    for path in paths:
+        if path in (source[0] for source in sources):
+            # Each file is read once, which also ends %include cycles
+            continue
+        source, fragment = read_fragment(path, default_section, use_cache)
+        sources.append(source)
+        if fragment is None:
+            continue
+        for pattern in fragment[2]:
+            if not any(c in pattern for c in '*?['):
+                read_fragments([pattern], default_section, use_cache,
+                               sources, fragments)
+                continue
+            # Notice when a file is added to or removed from the directory
+            sources.append(read_source(os.path.dirname(pattern))[0])
+            read_fragments(sorted(glob(pattern)), default_section,
+                           use_cache, sources, fragments)
+        fragments.append((path, fragment))
+
+
+def read_files(paths, default_section, use_cache=True):
+    """Return (sources, config) for the files and the files they include,
+    where sources is what the config needs to be checked against to know
+    if it is still current
+
+    """
+    sources, fragments = [], []
+    read_fragments(paths, default_section, use_cache, sources, fragments)
+    config = SafeConfigParser(default_section=default_section)
+    config.optionxform = str
+    for path, (defaults, sections, _) in fragments:
+        # Merge in the same way reading the files one after another would
+        items = [(config.default_section, defaults)] + sections
+        config.read_dict(OrderedDict(items), source=path)
+        config.name = path
+    return sources, config
 
 
 def parse_configs(fds, default_section=None):
@@ -143,7 +518,7 @@ def parse_configs(fds, default_section=None):
     for fd in fds:
         if fd is None:
             continue
-        config.readfp(fd)
+        config.read_file(fd)
         config.name = fd.name
     return config
 
@@ -0,0 +1,247 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Runs hubble environments from an asyncio event loop, without blocking
+the loop or starting the hubble command line as a subprocess.
+
+    import hubble
+
+    async def main():
+        async for result in hubble.stream_async('cinder-all', ['list']):
+            print(result.section, result.returncode, result.stdout)
+
+        results = await hubble.run_async('dfw', ['list'])
+
+The opt-cmd, env-cmd and the command itself are run with asyncio
+subprocesses. Cancelling the task stops the commands still running,
+along with anything they started.
+"""
+
+import asyncio
+from configparser import NoSectionError
+import os
+import signal
+from subprocess import CalledProcessError, PIPE
+import time
+
+from hubble import cache
+from hubble import shell
+from hubble.config import read_configs
+from hubble.output import KILL_GRACE
+
+
+class Result(object):
+    """ How the command of a single section went """
+    def __init__(self, section, command, returncode, stdout, stderr, start,
+                 end, timed_out=False):
+        self.section = section
+        self.command = command
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.start = start
+        self.end = end
+        self.timed_out = timed_out
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def to_dict(self):
+        return dict(section=self.section, command=self.command,
+                    returncode=self.returncode, stdout=self.stdout,
+                    stderr=self.stderr, start=self.start, end=self.end,
+                    duration=self.duration, timed_out=self.timed_out)
+
+    def __repr__(self):
+        return "Result('%s', %s)" % (self.section, self.returncode)
+
+
+def signal_group(proc, signum):
+    """ Signal the process group the command leads """
+    try:
+        os.killpg(proc.pid, signum)
+    except ProcessLookupError:
+        pass
+
+
+async def terminate(proc, grace=KILL_GRACE):
+    """ Ask the command to stop, and kill it if it takes longer than grace """
+    if proc.returncode is not None:
+        return
+    signal_group(proc, signal.SIGTERM)
+    try:
+        await asyncio.wait_for(proc.wait(), grace)
+    except asyncio.TimeoutError:
+        signal_group(proc, signal.SIGKILL)
+        await proc.wait()
+
+
+async def communicate(proc, timeout=None):
+    """
+    Return (stdout, stderr, timed_out) once the command exits. The
+    command is stopped if it runs longer than timeout or we are cancelled
+    """
+    output = asyncio.ensure_future(proc.communicate())
+    try:
+        done, _ = await asyncio.wait([output], timeout=timeout)
+    except asyncio.CancelledError:
+        output.cancel()
+        await terminate(proc)
+        raise
+    if not done:
+        # Keep what it wrote before we stopped it
+        await terminate(proc)
+    stdout, stderr = await output
+    return stdout, stderr, not done
+
+
+async def run(cmd, env):
+    """ Run the opt-cmd or env-cmd and return its key=value output """
+    if shell.empty(cmd):
+        return {}
+    environ = os.environ.copy()
+    environ.update(env.to_dict())
+    proc = await asyncio.create_subprocess_shell(cmd, stdout=PIPE,
+                                                 env=environ,
+                                                 start_new_session=True)
+    output, _, _ = await communicate(proc)
+    if proc.returncode:
+        raise CalledProcessError(proc.returncode, cmd, output)
+    return shell.to_dict(output)
+
+
+async def run_cached(name, env, refresh=False):
+    """ Like shell.run_cached() but without blocking the loop """
+    cmd, path, ttl = shell.cmd_cache(name, env)
+    if path is None:
+        return await run(cmd, env)
+    if not refresh:
+        result = shell.load_cached(path)
+        if result is not None:
+            return result
+    result = await run(cmd, env)
+    cache.save(path, (time.time() + ttl, result))
+    return result
+
+
+async def resolve_environment(env, refresh=False):
+    """ Expand the variables and run the opt-cmd and env-cmd """
+    env.eval()
+    if 'opt-cmd' in env:
+        env.add(await run_cached('opt-cmd', env, refresh))
+    if 'env-cmd' in env:
+        env.add(await run_cached('env-cmd', env, refresh))
+    return env
+
+
+async def resolve_environments(args, choice, config):
+    """ Return the resolved environments of 'choice' """
+    envs = shell.build_environments(args, choice, config)
+    # The keyring may well block, keep it off the loop
+    loop = asyncio.get_event_loop()
+    await loop.run_in_executor(None, shell.prefetch_keyring, envs, config)
+    results = await asyncio.gather(*[
+        resolve_environment(env, args.refresh) for env in envs],
+        return_exceptions=True)
+    errors = [shell.resolve_error(env, e) for env, e in zip(envs, results)
+              if isinstance(e, (RuntimeError, EnvironmentError,
+                                CalledProcessError))]
+    if errors:
+        raise RuntimeError("\n-- ".join(errors))
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def execute(env, config, hubble_args, args, limit):
+    """ Run the command in the environment and return the Result() """
+    cmd = shell.get_cmd(['hubble'], config, env, hubble_args)
+    argv, environ = shell.prepare_environment(cmd, env, hubble_args, args)
+    async with limit:
+        start = time.time()
+        try:
+            proc = await asyncio.create_subprocess_exec(
+                *argv, stdout=PIPE, stderr=PIPE, env=environ,
+                start_new_session=True)
+        except OSError as e:
+            raise shell.exec_failed(cmd, e)
+        stdout, stderr, timed_out = await communicate(
+            proc, shell.get_timeout(hubble_args, env))
+    return Result(env['section'].value, argv, proc.returncode, stdout,
+                  stderr, start, time.time(), timed_out)
+
+
+async def start_tasks(choice, args=(), files=None, execute_cmd=None,
+                      option=None, parallel=0, timeout=None, refresh=False):
+    """
+    Resolve the environments and return a task running the command of
+    each section, in the order the sections are listed
+    """
+    config = read_configs(files=files, default_section='hubble')
+    if config.get_error():
+        raise RuntimeError(config.get_error())
+    hubble_args = shell.library_args(choice, execute=execute_cmd,
+                                     option=option, refresh=refresh,
+                                     timeout=timeout)
+    try:
+        envs = await resolve_environments(hubble_args, choice, config)
+    except NoSectionError:
+        raise RuntimeError("no such environment [%s]" % choice)
+    limit = asyncio.Semaphore(parallel or len(envs))
+    return [asyncio.ensure_future(execute(env, config, hubble_args,
+                                          list(args), limit))
+            for env in envs]
+
+
+async def cancel(tasks):
+    """ Stop the commands still running and wait for them to go away """
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def stream_async(choice, args=(), files=None, execute=None,
+                       option=None, parallel=0, timeout=None, refresh=False):
+    """
+    Run the command of each section 'choice' picks with 'args' and yield
+    a Result() for each section as soon as its command exits. 'execute'
+    runs a command other than the 'cmd' of the sections, 'parallel'
+    limits how many commands run at once and 'timeout' how many seconds
+    each may run for, 'option' is passed to the opt-cmd
+    """
+    tasks = await start_tasks(choice, args, files, execute, option,
+                              parallel, timeout, refresh)
+    try:
+        for future in asyncio.as_completed(tasks):
+            yield await future
+    finally:
+        # We were cancelled or the caller stopped listening
+        await cancel(tasks)
+
+
+async def run_async(choice, args=(), files=None, execute=None, option=None,
+                    parallel=0, timeout=None, refresh=False):
+    """
+    Run the command of each section 'choice' picks and return a list of
+    Result() in the order the sections are listed. Takes the same
+    arguments as stream_async()
+    """
+    tasks = await start_tasks(choice, args, files, execute, option,
+                              parallel, timeout, refresh)
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        await cancel(tasks)
@@ -19,11 +19,109 @@ from __future__ import print_function
 
 from argparse import ArgumentParser, RawDescriptionHelpFormatter
 import getpass
+import os
+import threading
+import time
 
-import keyring
-
+from hubble.cache import private_dir, runtime_dir
 from hubble.config import validate_variable_exists
 
+# The keyring module, see backend()
+keyring = None
+# Credentials already fetched by this process, by keyring key
+_passwords = {}
+_lock = threading.Lock()
+# The SessionCache() in use, if any, see use_session_cache()
+session = None
+
+
+class SessionCache(object):
+    """
+    Keeps credentials fetched from the keyring in a file on a tmpfs,
+    readable only by the current user, for 'ttl' seconds so invocations
+    that follow each other don't have to ask the keyring again.
+    """
+    def __init__(self, ttl, path=None):
+        self.ttl = ttl
+        self.path = path or session_path()
+        self.entries = None
+
+    def load(self):
+        if self.entries is not None:
+            return self.entries
+        self.entries = {}
+        if not private_dir(os.path.dirname(self.path)):
+            return self.entries
+        import json
+        now = time.time()
+        try:
+            with open(self.path) as fd:
+                entries = json.load(fd)
+            self.entries = dict((k, v) for k, v in entries.items()
+                                if v[0] > now)
+        except (IOError, OSError, ValueError, TypeError, AttributeError,
+                IndexError, KeyError):
+            return self.entries
+        if len(self.entries) != len(entries):
+            # Credentials must not outlive their ttl
+            self.save()
+        return self.entries
+
+    def get(self, key):
+        entry = self.load().get(key)
+        if entry is not None and entry[0] > time.time():
+            return entry[1]
+        return None
+
+    def update(self, passwords):
+        """ Store the dict of {key: password} and write the file """
+        expires = time.time() + self.ttl
+        for key, password in passwords.items():
+            self.load()[key] = [expires, password]
+        self.save()
+
+    def discard(self, key):
+        if self.load().pop(key, None) is not None:
+            self.save()
+
+    def save(self):
+        """ Write the entries, the file is removed once there are none """
+        import json
+        import tempfile
+        if not private_dir(os.path.dirname(self.path)):
+            return
+        if not self.entries:
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path))
+            with os.fdopen(fd, 'w') as file:
+                json.dump(self.entries, file)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            pass
+
+
+def session_path():
+    """
+    Return where the session cache lives, this must be on a tmpfs so
+    credentials never touch the disk. Returns None if there is no such
+    place for this user
+    """
+    path = runtime_dir()
+    return None if path is None else os.path.join(path, 'keyring.json')
+
+
+def use_session_cache(ttl):
+    """ Cache credentials between invocations for 'ttl' seconds """
+    global session
+    session = None
+    if ttl > 0 and session_path() is not None:
+        session = SessionCache(ttl)
+
 
 def main():
     description = """
@@ -80,14 +178,78 @@ def main():
         return 1
 
 
-def get_password(env, variable):
+def backend():
+    """
+    Return the keyring module. Importing keyring is slow, so it is only
+    imported once a credential is actually needed
+    """
+    global keyring
+    if keyring is None:
+        import keyring as module
+        keyring = module
+    return keyring
+
+
+def available():
+    """ Return True if the keyring module is installed """
+    try:
+        backend()
+    except ImportError:
+        return False
+    return True
+
+
+def keyring_key(env, variable):
     # If no variable, the we are getting a global
     if variable is None:
-        variable = env
-        env = '__global__'
-    key = '%s:%s' % (env, variable)
-    cred = keyring.get_password('hubble', key)
+        return '__global__:%s' % env
+    return '%s:%s' % (env, variable)
+
+
+def fetch(key):
+    """ Return the credential for 'key', asking the keyring only once """
+    with _lock:
+        if key in _passwords:
+            return _passwords[key]
+        cred = session.get(key) if session else None
+        if cred is None:
+            cred = backend().get_password('hubble', key)
+            if cred is not None and session:
+                session.update({key: cred})
+        _passwords[key] = cred
+        return cred
+
+
+def prefetch(refs):
+    """
+    Fetch the credentials for a list of (env, variable) up front, each
+    credential is fetched once and the session cache is written once
+    """
+    with _lock:
+        wanted = set(keyring_key(env, var) for env, var in refs)
+        fetched = {}
+        for key in sorted(wanted - set(_passwords)):
+            cred = session.get(key) if session else None
+            if cred is None:
+                cred = fetched[key] = backend().get_password('hubble',
+                                                             key)
+            _passwords[key] = cred
+        fetched = dict((k, v) for k, v in fetched.items() if v is not None)
+        if session and fetched:
+            session.update(fetched)
+
+
+def forget():
+    """ Drop every credential this process has fetched """
+    with _lock:
+        _passwords.clear()
+
+
+def get_password(env, variable):
+    cred = fetch(keyring_key(env, variable))
     if cred is None:
+        if variable is None:
+            variable, env = env, '__global__'
         raise RuntimeError("No Such variable '%s' in environment [%s]"
                            " exists in keyring 'hubble' (use hubble-keyring "
                            "--set)" % (variable, env))
@@ -102,11 +264,17 @@ def set_password(env, variable, password):
             variable = env
             env = '__global__'
         key = '%s:%s' % (env, variable)
-        keyring.set_password('hubble', key, password)
+        backend().set_password('hubble', key, password)
+        # Don't let an old copy of the credential linger
+        if session_path() is not None:
+            SessionCache(0).discard(key)
+        # Nor a copy held by a running hubble-agent
+        from hubble import agent
+        agent.flush()
         print("\n-- Successfully stored credentials for variable '%s' in"
               " environment [%s] under keyring 'hubble'" %
               (variable, env))
-    except keyring.errors.PasswordSetError as e:
+    except backend().errors.PasswordSetError as e:
         raise RuntimeError("Unable to store credentials for variable '%s' in"
                            " environment [%s] under the hubble service - %s" %
                            (env, variable, str(e)))
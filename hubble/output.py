@@ -0,0 +1,588 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+import codecs
+from collections import deque
+import errno
+import os
+import signal
+import time
+
+try:
+    import selectors
+except ImportError:
+    import selectors34 as selectors
+
+from hubble import cache
+from hubble.timings import clock, timings
+
+# The most we read from a child in one go, this is also the most we hold
+# in memory for a partial line before giving up and writing it out
+CHUNK_SIZE = 65536
+# How much held back output we keep in memory before spilling to disk
+SPOOL_SIZE = 1024 * 1024
+# How long a child has to exit after SIGTERM before it gets SIGKILL
+KILL_GRACE = 3.0
+
+
+def green(msg):
+    """ ASCII encode the string with green """
+    return "\033[92m%s\033[0m" % msg
+
+
+def reap(p):
+    """
+    Wait for the Popen() 'p' to exit and return the exit code and the
+    resource usage of the child, or None where os.wait4() is missing
+    """
+    if not hasattr(os, 'wait4'):
+        return p.wait(), None
+    try:
+        _, status, rusage = os.wait4(p.pid, 0)
+    except OSError as e:
+        # Someone else already collected it
+        if e.errno != errno.ECHILD:
+            raise
+        return p.wait(), None
+    if os.WIFSIGNALED(status):
+        p.returncode = -os.WTERMSIG(status)
+    else:
+        p.returncode = os.WEXITSTATUS(status)
+    return p.returncode, rusage
+
+
+def fileno(target):
+    """ Return the file descriptor behind 'target' or None """
+    try:
+        return target.fileno()
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+
+
+def write_all(fd, data):
+    """ Write all of 'data' to the file descriptor 'fd' """
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+class Spool(object):
+    """
+    Output held back until it is our turn to write. It is kept in memory
+    until it grows past 'size' bytes, then moved to a temporary file
+    """
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray()
+        self.file = None
+        self.length = 0
+
+    def write(self, data):
+        self.length += len(data)
+        if self.file is None and len(self.buffer) + len(data) <= self.size:
+            self.buffer += data
+            return
+        if self.file is None:
+            import tempfile
+            self.file = tempfile.TemporaryFile()
+            self.file.write(self.buffer)
+            self.buffer = None
+        self.file.write(data)
+
+    def chunks(self):
+        if self.file is None:
+            for i in range(0, len(self.buffer), CHUNK_SIZE):
+                yield bytes(self.buffer[i:i + CHUNK_SIZE])
+            return
+        self.file.seek(0)
+        for chunk in iter(lambda: self.file.read(CHUNK_SIZE), b''):
+            yield chunk
+
+    def copy(self, fd):
+        """ Write everything held to the file descriptor 'fd' """
+        if self.file is None or not hasattr(os, 'sendfile'):
+            for chunk in self.chunks():
+                write_all(fd, chunk)
+            return
+        # Let the kernel copy from the file
+        self.file.flush()
+        offset = 0
+        while offset < self.length:
+            try:
+                sent = os.sendfile(fd, self.file.fileno(), offset,
+                                   self.length - offset)
+            except OSError as e:
+                if e.errno not in (errno.EINVAL, errno.ENOSYS) or offset:
+                    raise
+                for chunk in self.chunks():
+                    write_all(fd, chunk)
+                return
+            if not sent:
+                break
+            offset += sent
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+class Replay(object):
+    """ The output of a command from the output cache, played back """
+    def __init__(self, args, returncode, stdout, stderr):
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+
+
+class OutputCache(object):
+    """ Where the output of a command is cached, and for how long """
+    def __init__(self, path, ttl):
+        self.path = path
+        self.ttl = ttl
+
+    def load(self):
+        """ Return a Replay() of the output if it has not expired """
+        entry = cache.load(self.path)
+        if entry is None or entry[0] <= time.time():
+            return None
+        return Replay(*entry[1:])
+
+    def save(self, section):
+        """ Cache the output of a section whose command succeeded """
+        output = [stream.capture for stream in section.streams]
+        if section.returncode or section.timed_out or None in output:
+            return False
+        return cache.save(self.path, (time.time() + self.ttl,
+                                      section.command, section.returncode,
+                                      bytes(output[0]), bytes(output[1])))
+
+
+class Stream(object):
+    """
+    The stdout or stderr pipe of a single child process. Output goes
+    straight to the file descriptor of 'target' as bytes if it has one,
+    else it is decoded and written to 'target' as text
+    """
+    def __init__(self, section, fd, target, spool_size=SPOOL_SIZE):
+        self.section = section
+        self.fd = fd
+        self.target = target
+        self.out = fileno(target)
+        self.pending = b''
+        self.spool = None
+        self.spool_size = spool_size
+        # Use splice() until the target turns out not to support it
+        self.splice = hasattr(os, 'splice') and self.out is not None
+        self.decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        # A copy of the output for the output cache
+        self.capture = None
+
+    def decode(self, data, final=False):
+        return self.decoder.decode(data, final)
+
+    def emit(self, data, final=False):
+        """ Write 'data' to the target """
+        if self.out is None:
+            text = self.decode(data, final)
+            if text:
+                self.target.write(text)
+                self.target.flush()
+            return
+        if data:
+            # Anything written as text must come first
+            self.target.flush()
+            write_all(self.out, data)
+
+    def splice_out(self, size):
+        """
+        Move up to 'size' bytes from the pipe straight to the target
+        without copying it through python. Returns the bytes moved, 0 at
+        the end of the stream or None if splice() can't be used
+        """
+        try:
+            self.target.flush()
+            return os.splice(self.fd, self.out, size)
+        except OSError as e:
+            if e.errno not in (errno.EINVAL, errno.ENOSYS):
+                raise
+            self.splice = False
+            return None
+
+    def keep(self, data):
+        """ Copy the output for the output cache, up to 'spool_size' """
+        if self.capture is None:
+            return
+        if len(self.capture) + len(data) > self.spool_size:
+            # Too large to cache
+            self.capture = None
+            return
+        self.capture += data
+
+    def hold(self, data):
+        """ Keep the data until it is our turn to write """
+        if not data:
+            return
+        if self.spool is None:
+            self.spool = Spool(self.spool_size)
+        self.spool.write(data)
+
+    def size(self):
+        """ Return how many bytes are held """
+        return self.spool.length if self.spool is not None else 0
+
+    def held(self):
+        """ Yield the held data in chunks and discard it """
+        if self.spool is None:
+            return
+        for chunk in self.spool.chunks():
+            yield chunk
+        self.discard()
+
+    def release(self):
+        """ Write the held data to the target and discard it """
+        if self.spool is None:
+            return
+        if self.out is None:
+            for chunk in self.held():
+                self.emit(chunk)
+            return
+        self.target.flush()
+        self.spool.copy(self.out)
+        self.discard()
+
+    def discard(self):
+        self.spool.close()
+        self.spool = None
+
+
+class Section(object):
+    """ The output streams and process for a single section """
+    def __init__(self, name, p):
+        self.name = name
+        self.process = p
+        self.streams = []
+        self.open = 0
+        self.returncode = None
+        self.started = timings.now()
+        self.start = time.time()
+        self.command = getattr(p, 'args', None)
+        # When to send SIGTERM and when to give up and send SIGKILL
+        self.deadline = None
+        self.kill_at = None
+        self.timed_out = False
+        self.cancelled = False
+        # Where the output is cached, None if it isn't
+        self.cache = None
+        self.cached = False
+
+    @property
+    def closed(self):
+        return self.returncode is not None
+
+
+class Multiplexer(object):
+    """
+    Streams the stdout and stderr of many child processes as it arrives.
+
+    When 'headers' is True the output is kept in the order the sections
+    were added; a '-- [section] --' header is written for each section and
+    the oldest running section streams live while the output of the others
+    is held until their turn. When 'prefix' is True every line is tagged
+    with '[section] ' and written as soon as it is complete. At most
+    'chunk_size' bytes per stream are held in memory for partial lines and
+    held output spills to disk past 'spool_size' bytes.
+
+    Output is copied as raw bytes to the file descriptors of stdout and
+    stderr, using splice() where the platform has it, or decoded as
+    UTF-8 and written as text if they have no file descriptor.
+
+    When 'records' is True nothing is streamed, instead a JSON record of
+    the exit code, timing and output of each section is written to stdout
+    as each child exits. Output larger than 'spool_size' is left in a file
+    and the record has the path instead.
+    """
+    def __init__(self, stdout, stderr, headers=False, prefix=False,
+                 chunk_size=CHUNK_SIZE, records=False, spool_size=SPOOL_SIZE):
+        self.stdout = stdout
+        self.stderr = stderr
+        self.headers = headers and not records
+        self.prefix = prefix and not records
+        self.records = records
+        self.chunk_size = chunk_size
+        self.spool_size = spool_size
+        # Where output too large for a record is kept
+        self.spool_dir = None
+        self.selector = selectors.DefaultSelector()
+        self.sections = []
+        # Sections waiting for their turn to write, the first is live
+        self.queue = deque()
+
+    def add(self, name, p, timeout=None, output_cache=None):
+        """
+        Watch the stdout and stderr of the Popen() 'p', the child is
+        terminated if it runs for longer than 'timeout' seconds. If
+        'output_cache' is given the output is saved there once the child
+        exits successfully. 'p' may also be a Replay() from the output
+        cache. Returns the Section()
+        """
+        if isinstance(p, Replay):
+            return self.replay(name, p)
+        section = Section(name, p)
+        if timeout:
+            section.deadline = clock() + timeout
+        section.cache = output_cache
+        for pipe, target in ((p.stdout, self.stdout),
+                             (p.stderr, self.stderr)):
+            stream = Stream(section, pipe.fileno(), target, self.spool_size)
+            if output_cache is not None:
+                # We need to see the output to keep a copy
+                stream.capture = bytearray()
+                stream.splice = False
+            section.streams.append(stream)
+            section.open += 1
+            self.selector.register(pipe, selectors.EVENT_READ, stream)
+        self.queue_section(section)
+        return section
+
+    def queue_section(self, section):
+        self.sections.append(section)
+        if self.records:
+            return
+        self.queue.append(section)
+        if len(self.queue) == 1:
+            self.header(section)
+
+    def replay(self, name, replay):
+        """ Write the cached output of a command as if it just ran """
+        section = Section(name, replay)
+        section.cached = True
+        section.streams = [Stream(section, None, target, self.spool_size)
+                           for target in (self.stdout, self.stderr)]
+        self.queue_section(section)
+        for stream, data in zip(section.streams,
+                                (replay.stdout, replay.stderr)):
+            if data:
+                self.feed(stream, data)
+            self.flush(stream)
+        section.returncode = replay.returncode
+        if self.records:
+            self.record(section)
+        self.advance()
+        return section
+
+    def results(self):
+        """ Return a list of (name, returncode) in the order added """
+        return [(s.name, s.returncode) for s in self.sections]
+
+    def run(self):
+        """ Copy output until every child has exited """
+        while self.selector.get_map():
+            self.poll()
+        return self.results()
+
+    def poll(self, timeout=None):
+        """
+        Copy whatever output is available and return a list of the
+        sections whose child exited
+        """
+        finished = []
+        for key, _ in self.selector.select(self.wake(timeout)):
+            section = self.read(key.fileobj, key.data)
+            if section is not None:
+                finished.append(section)
+        self.expire()
+        return finished
+
+    def running(self):
+        return [s for s in self.sections if not s.closed]
+
+    def wake(self, timeout):
+        """ Return how long we can wait before a deadline needs handling """
+        times = [t for s in self.running() for t in (s.deadline, s.kill_at)
+                 if t is not None]
+        if not times:
+            return timeout
+        wait = max(min(times) - clock(), 0)
+        return wait if timeout is None else min(wait, timeout)
+
+    def expire(self):
+        """ Terminate the children that ran past their deadline """
+        now = clock()
+        for section in self.running():
+            if section.kill_at is not None and now >= section.kill_at:
+                section.kill_at = None
+                self.signal(section, signal.SIGKILL)
+            elif section.deadline is not None and now >= section.deadline:
+                section.timed_out = True
+                msg = "-- [%s] timed out\n" % section.name
+                self.feed(section.streams[1], msg.encode('utf-8'))
+                self.terminate(section)
+
+    def terminate(self, section):
+        """ Ask the child to exit, it is killed if it hasn't in time """
+        section.deadline = None
+        section.kill_at = clock() + KILL_GRACE
+        self.signal(section, signal.SIGTERM)
+
+    def terminate_all(self):
+        """ Terminate every child that is still running """
+        for section in self.running():
+            if section.kill_at is None:
+                section.cancelled = True
+                self.terminate(section)
+
+    def cancel(self):
+        """ Terminate every child and wait for them to exit """
+        self.terminate_all()
+        self.run()
+
+    def signal(self, section, signum):
+        """ Signal the process group of the child if it leads one """
+        pid = section.process.pid
+        try:
+            if os.getpgid(pid) == pid:
+                os.killpg(pid, signum)
+            else:
+                os.kill(pid, signum)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def read(self, pipe, stream):
+        moved = None
+        if self.direct(stream):
+            moved = stream.splice_out(self.chunk_size)
+            if moved:
+                return None
+        data = os.read(stream.fd, self.chunk_size) if moved is None else b''
+        if data:
+            stream.keep(data)
+            self.feed(stream, data)
+            return None
+
+        self.selector.unregister(pipe)
+        pipe.close()
+        self.flush(stream)
+        section = stream.section
+        section.open -= 1
+        if section.open:
+            return None
+        # Both pipes are closed, collect the exit code
+        section.returncode, rusage = reap(section.process)
+        timings.add_child(section.name, section.started,
+                          section.returncode, rusage)
+        if section.cache is not None:
+            section.cache.save(section)
+        if self.records:
+            self.record(section)
+        self.advance()
+        return section
+
+    def record(self, section):
+        """ Write the JSON record of a section whose child has exited """
+        import json
+        end = time.time()
+        record = {'section': section.name, 'command': section.command,
+                  'returncode': section.returncode, 'start': section.start,
+                  'end': end, 'duration': end - section.start,
+                  'timed_out': section.timed_out,
+                  'cancelled': section.cancelled, 'cached': section.cached}
+        for name, stream in zip(('stdout', 'stderr'), section.streams):
+            if stream.size() > self.spool_size:
+                record[name + '_path'] = self.spill(section, name, stream)
+                continue
+            record[name] = ''.join(stream.decode(data)
+                                   for data in stream.held())
+            record[name] += stream.decode(b'', final=True)
+        self.stdout.write(json.dumps(record, sort_keys=True) + "\n")
+        self.stdout.flush()
+
+    def spill(self, section, name, stream):
+        """ Copy the held output to a file and return the path """
+        import tempfile
+        if self.spool_dir is None:
+            self.spool_dir = tempfile.mkdtemp(prefix='hubble-')
+        # The same section may appear more than once in a meta
+        path = os.path.join(self.spool_dir, '%d-%s.%s' % (
+            self.sections.index(section), section.name.replace(os.sep, '_'),
+            name))
+        with open(path, 'wb') as fd:
+            stream.spool.copy(fd.fileno())
+        stream.discard()
+        return path
+
+    def advance(self):
+        """ Let the next section in line write once the live one is done """
+        while self.queue and self.queue[0].closed:
+            self.queue.popleft()
+            if not self.queue:
+                return
+            section = self.queue[0]
+            self.header(section)
+            for stream in section.streams:
+                stream.release()
+                if section.closed:
+                    stream.emit(b'', final=True)
+
+    def header(self, section):
+        if self.headers:
+            self.stdout.write("-- [%s] --\n" % green(section.name))
+            self.stdout.flush()
+
+    def feed(self, stream, data):
+        if not self.prefix:
+            return self.write(stream, data)
+
+        # Only write out whole lines, unless the partial line
+        # has grown larger than we are willing to hold on to
+        data = stream.pending + data
+        index = data.rfind(b'\n') + 1
+        if index == 0 and len(data) < self.chunk_size:
+            stream.pending = data
+            return
+        if index == 0:
+            index = len(data)
+        stream.pending = data[index:]
+        self.write(stream, data[:index])
+
+    def flush(self, stream):
+        """ Write out anything left over once the stream has closed """
+        data, stream.pending = stream.pending, b''
+        if data and not data.endswith(b'\n'):
+            data += b'\n'
+        self.write(stream, data, final=True)
+
+    def live(self, stream):
+        """ Return True if the output of 'stream' can be written now """
+        if self.records:
+            return False
+        return not self.headers or self.queue[0] is stream.section
+
+    def direct(self, stream):
+        """ Return True if the output can skip python altogether """
+        return stream.splice and not self.prefix and self.live(stream)
+
+    def write(self, stream, data, final=False):
+        if not self.live(stream):
+            return stream.hold(data)
+        if self.prefix and data:
+            tag = ("[%s] " % stream.section.name).encode('utf-8')
+            lines = data.split(b'\n')
+            tail = lines.pop()
+            data = b''.join(tag + line + b'\n' for line in lines)
+            # A partial line too long to hold on to
+            if tail:
+                data += tag + tail
+        stream.emit(data, final)
@@ -0,0 +1,113 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""
+Resolves hubble environments inside your own python program, for tools
+that would otherwise run hubble once per command to get credentials.
+
+    import hubble
+
+    resolver = hubble.Resolver()
+    env = resolver.resolve('dfw')
+    subprocess.call(['nova', 'list'], env=dict(os.environ, **env))
+
+The config is read once and every environment is resolved once, until
+invalidate() is called.
+"""
+
+import threading
+
+# Resolver is imported with the hubble package, the modules it uses are
+# only loaded once it is used so importing any part of hubble stays cheap
+
+
+class Resolver(object):
+    """
+    Returns the variables hubble would export for an environment as a
+    plain dict. The config is read the first time it is needed and the
+    result of every resolve() is kept, so resolving the same environment
+    again reads nothing and runs no opt-cmd or env-cmd. Safe to share
+    between threads.
+    """
+    def __init__(self, files=None):
+        # The config files to read, by default the same as hubble reads
+        self.files = files
+        self._config = None
+        # Lists of resolved environments by (choice, option)
+        self.environments = {}
+        self.lock = threading.Lock()
+
+    @property
+    def config(self):
+        """ The parsed config, read the first time it is used """
+        from hubble.config import read_configs
+        with self.lock:
+            if self._config is None:
+                config = read_configs(files=self.files,
+                                      default_section='hubble')
+                if config.get_error():
+                    raise RuntimeError(config.get_error())
+                self._config = config
+            return self._config
+
+    def resolve(self, section, option=None):
+        """
+        Return the environment of 'section' as a dict of the variables
+        the command would see if hubble ran it, 'option' is passed to the
+        opt-cmd like -o does
+        """
+        envs = self.resolve_all(section, option)
+        if len(envs) != 1:
+            raise RuntimeError("[%s] has %d environments, use resolve_all()"
+                               % (section, len(envs)))
+        return envs[0]
+
+    def resolve_all(self, choice, option=None):
+        """
+        Return a dict for each environment of 'choice', which may be a
+        meta section or a selector like '@tag' or 'glob:pattern'
+        """
+        # The stdlib configparser on python 3, the backport on python 2
+        from configparser import NoSectionError
+        from hubble.shell import get_environments, library_args
+        key = (choice, option)
+        with self.lock:
+            envs = self.environments.get(key)
+        if envs is None:
+            args = library_args(choice, option=option)
+            try:
+                envs = [env.to_dict() for env in
+                        get_environments(args, choice, self.config)]
+            except NoSectionError:
+                raise RuntimeError("no such environment [%s]" % choice)
+            with self.lock:
+                self.environments[key] = envs
+        # The caller is free to change what we hand out
+        return [dict(env) for env in envs]
+
+    def invalidate(self, choice=None):
+        """
+        Forget the resolved environments of 'choice', or if no choice is
+        given everything, so the config is read again and the credentials
+        are fetched again from the keyring
+        """
+        with self.lock:
+            if choice is not None:
+                for key in [key for key in self.environments
+                            if key[0] == choice]:
+                    del self.environments[key]
+                return
+            self.environments.clear()
+            self._config = None
+        from hubble import keys
+        keys.forget()
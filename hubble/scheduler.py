@@ -0,0 +1,67 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from collections import deque
+
+
+class Scheduler(object):
+    """
+    Runs jobs with no more than 'parallel' of them in flight at once,
+    starting the next job as soon as a running one exits. A 'parallel'
+    of 0 runs every job at once. With 'fail_fast' the first job to exit
+    non-zero cancels the jobs still running and those yet to start.
+    """
+    def __init__(self, mux, parallel=0, fail_fast=False):
+        self.mux = mux
+        self.parallel = parallel
+        self.fail_fast = fail_fast
+
+    def full(self, running):
+        return self.parallel and running >= self.parallel
+
+    def run(self, jobs):
+        """
+        Run a list of (name, start, timeout, output_cache) jobs in order,
+        where start() returns a Popen() with stdout and stderr pipes or a
+        Replay() of cached output, timeout is the most seconds the job may
+        run or None and output_cache is where to cache the output or None.
+        Returns a list of (name, returncode) for the jobs started, in the
+        order started
+        """
+        pending = deque(jobs)
+        running = 0
+        try:
+            while pending or running:
+                while pending and not self.full(running):
+                    name, start, timeout, output_cache = pending.popleft()
+                    section = self.mux.add(name, start(), timeout,
+                                           output_cache)
+                    if section.closed:
+                        # Replayed, there is no child to wait for
+                        self.finished(section, pending)
+                    else:
+                        running += 1
+                for section in self.mux.poll() if running else ():
+                    running -= 1
+                    self.finished(section, pending)
+        except KeyboardInterrupt:
+            # Take the children down with us
+            self.mux.cancel()
+            raise
+        return self.mux.results()
+
+    def finished(self, section, pending):
+        if self.fail_fast and section.returncode:
+            pending.clear()
+            self.mux.terminate_all()
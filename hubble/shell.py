@@ -15,49 +15,180 @@
 from __future__ import print_function
 
 import argparse
+from collections import namedtuple
+# The stdlib configparser on python 3, the backport on python 2
+from configparser import NoOptionError, NoSectionError
+from contextlib import contextmanager
+import errno
+from functools import partial
 import logging
 import os
 import re
-from subprocess import check_output, PIPE, Popen
+import signal
+from subprocess import CalledProcessError, check_output, PIPE, Popen
 import sys
-import textwrap
+import time
 
-from backports.configparser import NoOptionError, NoSectionError
+from hubble import agent
+from hubble import cache
+from hubble import keys
+from hubble.config import is_selector, ListConfigParser, read_configs, \
+    string_types
+from hubble.timings import clock, parse_spec, timings
 
-from hubble.config import read_configs
 
-try:
-    # Not everyone needs keyring
-    from hubble import keys
-except ImportError:
-    keys = None
+log = logging.getLogger(__name__)
 
+# Matches a ${variable} reference
+VARIABLE = re.compile(r'\$\{([^\s}]+)\}')
+# Values we have already compiled into a Template()
+_templates = {}
+# Variable names a shell will accept
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
 
-log = logging.getLogger(__name__)
 
+class Template(object):
+    """ A value split into literal text and ${variable} references """
+    def __init__(self, value):
+        # Literal text is at the even indexes, variable names at the odd
+        self.parts = VARIABLE.split(value)
+        self.refs = self.parts[1::2]
 
-class Env(dict):
-    """ A dict() collection of Pair() objects """
+    def render(self, values):
+        """ Return the value with each reference replaced from 'values' """
+        if not self.refs:
+            return self.parts[0]
+        parts = list(self.parts)
+        parts[1::2] = [values[key] for key in self.refs]
+        return ''.join(parts)
 
-    class Pair():
-        """
-        Pair object that knows if the key=value should be
-        exported to the environment or not
-        """
-        def __init__(self, value='', section='', export=''):
-            self.value = value
-            self.export = export
-            self.section = section
 
-        def endswith(self, needle):
-            return self.value.endswith(needle)
+def compile_template(value):
+    """ Return the Template() for 'value', compiling it only once """
+    try:
+        return _templates[value]
+    except KeyError:
+        pass
+    # Don't let a long running process grow without bound
+    if len(_templates) > 4096:
+        _templates.clear()
+    template = _templates[value] = Template(value)
+    return template
+
+
+class Pair(namedtuple('Pair', 'value section export')):
+    """
+    A value that knows if the key=value should be exported to the
+    environment or not. A section of None is the section of whichever
+    environment the value ends up in. Pairs never change so they can be
+    shared between environments
+    """
+    __slots__ = ()
+
+    def __new__(cls, value='', section='', export=''):
+        return super(Pair, cls).__new__(cls, value, section, export)
+
+    def endswith(self, needle):
+        return self.value.endswith(needle)
+
+    def __repr__(self):
+        return "Pair('%s', %s)" % (self.value, self.export)
+
+
+# Marks a variable deleted from a layer below
+DELETED = None
+
+
+class Env(object):
+    """
+    A collection of Pair() objects kept as a stack of layers. Lookups
+    start at the top layer and every change goes to the top layer, so an
+    Env() stacked on a 'parent' shares the parents layers without ever
+    changing them. A parent must not change once an Env() is stacked on it
+    """
+    __slots__ = ('parent', 'layer', '_items')
+
+    Pair = Pair
+
+    def __init__(self, parent=None):
+        self.parent = parent
+        self.layer = {}
+        # The flattened layers, built on demand
+        self._items = None
+
+    def __getitem__(self, key):
+        env = self
+        while env is not None:
+            pair = env.layer.get(key, env)
+            if pair is not env:
+                if pair is DELETED:
+                    break
+                return pair
+            env = env.parent
+        raise KeyError(key)
+
+    def __setitem__(self, key, pair):
+        self._items = None
+        self.layer[key] = pair
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._items = None
+        if self.parent is not None and key in self.parent:
+            self.layer[key] = DELETED
+        else:
+            del self.layer[key]
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def __iter__(self):
+        return iter(self.flatten())
+
+    def __len__(self):
+        return len(self.flatten())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self.flatten().keys()
 
-        def __repr__(self):
-            return "Pair('%s', %s)" % (self.value, self.export)
+    def items(self):
+        return self.flatten().items()
+
+    def flatten(self):
+        """ Return a dict of every variable visible from the top layer """
+        if self._items is not None:
+            return self._items
+        items = dict(self.parent.flatten()) if self.parent else {}
+        for key, pair in self.layer.items():
+            if pair is DELETED:
+                items.pop(key, None)
+            else:
+                items[key] = pair
+        self._items = items
+        return items
+
+    def section_of(self, pair):
+        """ Return the section 'pair' belongs to in this environment """
+        if pair.section is not None:
+            return pair.section
+        section = self.get('section')
+        return section.value if section is not None else None
 
     def set(self, key, value, section, export=True):
         """ Sets the value with a Pair() """
-        self[key] = self.Pair(value, section, export)
+        self._items = None
+        self.layer[key] = tuple.__new__(Pair, (value, section, export))
 
     def delete(self, key):
         """ A safe delete """
@@ -81,44 +212,87 @@ class Env(dict):
             self.set(key, value, section)
 
     def eval(self):
-        """ Exapand all the ${variable} directives in the collection """
-        for key, pair in self.items():
-            self[key].value = self.expand_var(key, pair)
+        """
+        Expand the ${variable} directives of every exported variable.
+        Variables are expanded after any variable they reference, only
+        variables an exported variable depends on are expanded at all.
+        """
+        pairs = self.flatten()
+        resolved = {}
+        for key, pair in pairs.items():
+            if pair.export:
+                self.resolve(key, pairs, resolved)
+        for key, value in resolved.items():
+            # Only the values that changed are copied to the top layer,
+            # the layers below may be shared with other environments
+            pair = pairs[key]
+            if value != pair.value:
+                self.set(key, value, self.section_of(pair), pair.export)
         return self
 
-    def expand_var(self, variable, pair):
-        """ Find a ${some_var} signature and expand it """
-        result = pair.value
-        # Find all the ${...}
-        for match in re.finditer("\$\{\S+\}", pair.value):
-            try:
-                # Extract the variable name from ${...}
-                var = match.group(0)
-                key = var[2:-1]
-                # Replace the entire ${...} sequence with the value named
-                result = result.replace(var, self.get(key).value)
-            except AttributeError:
+    def resolve(self, variable, pairs, resolved, path=()):
+        """
+        Return the expanded value of 'variable', expanding the variables
+        it references first. Expanded values are kept in 'resolved'
+        """
+        try:
+            return resolved[variable]
+        except KeyError:
+            pass
+        if variable in path:
+            cycle = ' -> '.join(path[path.index(variable):] + (variable,))
+            raise RuntimeError("circular reference in environment variable "
+                               "'%s' (%s)" % (variable, cycle))
+
+        pair = pairs[variable]
+        template = compile_template(pair.value)
+        values = {}
+        for key in template.refs:
+            if key not in pairs:
                 raise RuntimeError("no such environment variable "
-                                   "'%s' in '%s'" % (key, result))
+                                   "'%s' in '%s'" % (key, pair.value))
+            values[key] = self.resolve(key, pairs, resolved,
+                                       path + (variable,))
         # Expand keyring values if any
-        return self.expand_keyring_var(variable, pair, result)
+        value = self.expand_keyring_var(variable, pair,
+                                        template.render(values))
+        resolved[variable] = value
+        return value
 
     def expand_keyring_var(self, variable, pair, value):
         """ Find 'USE_KEYRING' directives and expand them using the keyring """
-        identifier = value.strip()
-        if identifier.startswith("USE_KEYRING"):
-            if keys is None:
-                raise RuntimeError("found USE_KEYRING for '%s' but python "
-                                   "keyring or getpass modules are not "
-                                   "installed are required for keyring "
-                                   "support" % variable)
-            if identifier == "USE_KEYRING":
-                return keys.get_password(pair.section, variable)
-            else:
-                regex = "USE_KEYRING\[([\x27\x22])(.*)\\1\]"
-                variable = re.match(regex, value).group(2)
-                return keys.get_password(variable, None)
-        return value
+        ref = keyring_ref(variable, self.section_of(pair), value)
+        if ref is None:
+            return value
+        if not keys.available():
+            raise RuntimeError("found USE_KEYRING for '%s' but python "
+                               "keyring or getpass modules are not "
+                               "installed are required for keyring "
+                               "support" % variable)
+        return keys.get_password(*ref)
+
+    def keyring_refs(self):
+        """
+        Return the (env, variable) of every keyring credential eval()
+        is going to ask the keyring for
+        """
+        pairs = self.flatten()
+        refs, seen = [], set()
+        stack = [key for key, pair in pairs.items() if pair.export]
+        while stack:
+            key = stack.pop()
+            if key in seen or key not in pairs:
+                continue
+            seen.add(key)
+            pair = pairs[key]
+            template = compile_template(pair.value)
+            stack.extend(template.refs)
+            # Values that are the result of an expansion are looked up
+            # when they are expanded
+            ref = keyring_ref(key, self.section_of(pair), pair.value)
+            if ref is not None and not template.refs:
+                refs.append(ref)
+        return refs
 
     def to_dict(self):
         """
@@ -136,16 +310,28 @@ class Env(dict):
                           self.items()])
 
 
+def keyring_ref(variable, section, value):
+    """
+    Return the (env, variable) to ask the keyring for if 'value' is a
+    USE_KEYRING directive, else None. 'section' is the section the
+    variable belongs to
+    """
+    identifier = value.strip()
+    if not identifier.startswith("USE_KEYRING"):
+        return None
+    if identifier == "USE_KEYRING":
+        return section, variable
+    match = re.match("USE_KEYRING\\[([\x27\x22])(.*)\\1\\]", value)
+    if match is None:
+        return None
+    return match.group(2), None
+
+
 def empty(value):
     """ Return true if 'value' only has spaces or is empty """
     return value is None or re.match('^(|\s*)$', value) is not None
 
 
-def green(msg):
-    """ ASCII encode the string with green """
-    return "\033[92m%s\033[0m" % msg
-
-
 def get_cmd(argv, conf, env, hubble_args):
     # If our invocation name is not 'hubble'
     if not argv[0].endswith('hubble'):
@@ -162,49 +348,247 @@ def get_cmd(argv, conf, env, hubble_args):
                            "your config")
 
 
+def build_environments(args, choice, config):
+    """
+    Return an Env() for each section 'choice' runs, in the order they
+    run. Nothing is expanded or run yet
+    """
+    sections = [choice]
+    # The variables in every section, each belongs to the section of the
+    # environment it ends up in
+    shared = Env()
+    shared.add(dict(config.items(config.default_section)))
+    conf = shared
+
+    if is_selector(choice) and not config.has_section(choice):
+        # Pick the sections by tag or pattern
+        sections = select_sections(config, choice)
+    else:
+        # Stack the requested environment on the shared variables
+        conf = Env(shared)
+        conf.add(config.section_items(choice), choice)
+        # If requested section is a meta section
+        if 'meta' in conf:
+            sections = meta_plan(config, choice, conf['meta'].value)
+        else:
+            conf = shared
+
+    return [build_environment(args, section, conf, config)
+            for section in sections]
+
+
 def get_environments(args, choice, config):
     """ Get the environment collection requested from args.env """
-    sections = [choice]
-    results = []
-    conf = Env()
-
-    # Merge in the requested environment
-    conf.add(dict(config.items(choice)), choice)
-    # If requested section is a meta section
-    if 'meta' in conf:
-        # Evaluate the list of sections this is a meta for
-        sections = eval(conf['meta'].value)
-
-    for section in sections:
-        env = Env()
-        # Add the name of the section
-        env.add({'section': section}, section)
-        # Add the choosen section
-        env.update(conf)
-        # Add the env section
-        env.add(dict(config.items(section)), section)
-
-        def f(i):
-            return "opt.%s" % i[0], str(i[1])
-        # Add the args to the environment as opt.'<arg_name>'
-        env.add(dict(map(f, vars(args).items())), section)
+    envs = build_environments(args, choice, config)
+    with timings.span('keyring'):
+        prefetch_keyring(envs, config)
+    refresh = getattr(args, 'refresh', False)
+    return resolve_each(args, config, envs,
+                        partial(resolve_environment, refresh=refresh))
+
+
+def expand_environments(args, choice, config):
+    """
+    Like get_environments() but only the variables are expanded, the
+    opt-cmd and env-cmd are left for run_commands()
+    """
+    envs = build_environments(args, choice, config)
+    with timings.span('keyring'):
+        prefetch_keyring(envs, config)
+    return resolve_each(args, config, envs, expand_environment)
 
-        env.eval()
 
-        # Populate environment vars by running opt-cmd
-        # if -o was passed on the commandline
-        if 'opt-cmd' in env:
-            env.add(run(env['opt-cmd'].value, env))
+def resolve_each(args, config, envs, resolve):
+    """
+    Return resolve(env) for each environment, the errors of every
+    section of a meta are raised together
+    """
+    if len(envs) == 1:
+        return [resolve(envs[0])]
 
-        # Populate environment vars by running the env-cmd if it exists
-        if 'env-cmd' in env:
-            env.add(run(env['env-cmd'].value, env))
+    # Resolve every section of the meta at once, opt-cmd and
+    # env-cmd spend most of their time waiting on the network
+    from concurrent.futures import ThreadPoolExecutor
+    workers = get_parallel(args, config) or len(envs)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(resolve, env) for env in envs]
 
-        # Apply var expansion
-        results.append(env)
+    results, errors = [], []
+    for env, future in zip(envs, futures):
+        try:
+            results.append(future.result())
+        except (RuntimeError, EnvironmentError, CalledProcessError) as e:
+            errors.append(resolve_error(env, e))
+    if errors:
+        raise RuntimeError("\n-- ".join(errors))
     return results
 
 
+def resolve_error(env, e):
+    return "unable to resolve [%s] - %s" % (env['section'].value, e)
+
+
+def library_args(choice, **kwargs):
+    """
+    Return the args to resolve 'choice' with when hubble is used as a
+    library, those the command line gives when no options are passed
+    """
+    args = dict(env=choice, option=None, execute=None, refresh=False,
+                timeout=None, debug=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def resolve_environments(args, choice, config, files=None):
+    """
+    Return the environments for 'choice', from a running hubble-agent if
+    there is one, else resolved here
+    """
+    with timings.span('agent'):
+        envs = agent.resolve(args, choice, files)
+    if envs is None:
+        return get_environments(args, choice, config)
+    # The agent leaves the commands to us, so a slow one
+    # doesn't hold up everyone else asking the agent
+    if any('opt-cmd' in env or 'env-cmd' in env for env in envs):
+        refresh = getattr(args, 'refresh', False)
+        with timings.span('resolve'):
+            envs = resolve_each(args, config, envs,
+                                partial(run_commands, refresh=refresh))
+    return envs
+
+
+def select_sections(config, selector):
+    """ Return the sections 'selector' picks, there must be at least one """
+    sections = config.section_index().select(selector)
+    if not sections:
+        raise RuntimeError("no sections match '%s'" % selector)
+    return sections
+
+
+def parse_meta(value):
+    """
+    Return the names in a meta= value without evaluating it. The value is
+    a selector, a python style list of names or one name per line
+    """
+    value = value.strip()
+    if value.startswith(('@', 'glob:')):
+        return [value]
+    if not value.startswith(('[', '(')):
+        return ListConfigParser.list_converter(value)
+    import ast
+    try:
+        names = ast.literal_eval(value)
+    except (ValueError, SyntaxError):
+        names = None
+    if not isinstance(names, (list, tuple)) or \
+            not all(isinstance(name, string_types) for name in names):
+        raise RuntimeError("meta must be a list of section names, got '%s'"
+                           % value)
+    return list(names)
+
+
+def meta_plan(config, choice, value):
+    """
+    Return the sections the meta section 'choice' runs, before anything
+    is resolved. Meta sections it lists are expanded in their place and
+    each section is only in the plan once, where it first appears
+    """
+    plan = []
+    expand_meta(config, value, (choice,), plan, set())
+    if not plan:
+        raise RuntimeError("meta section [%s] has no sections to run"
+                           % choice)
+    return plan
+
+
+def expand_meta(config, value, path, plan, seen):
+    """ Add the sections of a meta section to 'plan' """
+    for name in parse_meta(value):
+        sections = [name]
+        if is_selector(name) and not config.has_section(name):
+            # Selectors never pick meta sections
+            sections = select_sections(config, name)
+        for section in sections:
+            if section in path:
+                cycle = ' -> '.join(path[path.index(section):] + (section,))
+                raise RuntimeError("meta cycle detected [%s]" % cycle)
+            if not config.has_section(section):
+                raise RuntimeError("meta section [%s] lists [%s] which does "
+                                   "not exist" % (path[-1], section))
+            meta = config.section_items(section).get('meta')
+            if meta is not None:
+                expand_meta(config, meta, path + (section,), plan, seen)
+            elif section not in seen:
+                seen.add(section)
+                plan.append(section)
+
+
+def prefetch_keyring(envs, config):
+    """
+    Ask the keyring for every credential the environments need up front,
+    so each credential is only fetched once
+    """
+    refs = set()
+    for env in envs:
+        refs.update(env.keyring_refs())
+    # Don't even import keyring unless we need it
+    if not refs or not keys.available():
+        return
+    ttl = config.safe_get(config.default_section, 'keyring-cache-ttl')
+    try:
+        keys.use_session_cache(int(ttl or 0))
+    except ValueError:
+        raise RuntimeError("'keyring-cache-ttl' must be a number of "
+                           "seconds, got '%s'" % ttl)
+    keys.prefetch(refs)
+
+
+def build_environment(args, section, conf, config):
+    """
+    Collect the variables for a single section. Only what the section
+    sets is copied, the rest is shared with the other sections in 'conf'
+    """
+    env = Env(conf)
+    # Add the name of the section
+    env.add({'section': section}, section)
+    # Add the env section
+    env.add(config.section_items(section), section)
+
+    def f(i):
+        return "opt.%s" % i[0], str(i[1])
+    # Add the args to the environment as opt.'<arg_name>'
+    env.add(dict(map(f, vars(args).items())), section)
+    return env
+
+
+def resolve_environment(env, refresh=False):
+    """ Expand the variables and run the opt-cmd and env-cmd """
+    with timings.span('resolve', env['section'].value):
+        env.eval()
+        return run_commands(env, refresh)
+
+
+def expand_environment(env):
+    """ Expand the variables, the commands are left for run_commands() """
+    with timings.span('resolve', env['section'].value):
+        env.eval()
+    return env
+
+
+def run_commands(env, refresh=False):
+    """ Run the opt-cmd and env-cmd of an expanded environment """
+    # Populate environment vars by running opt-cmd
+    # if -o was passed on the commandline
+    if 'opt-cmd' in env:
+        env.add(run_cached('opt-cmd', env, refresh))
+
+    # Populate environment vars by running the env-cmd if it exists
+    if 'env-cmd' in env:
+        env.add(run_cached('env-cmd', env, refresh))
+    return env
+
+
 def to_dict(buf):
     """ Parse a string of 'key=value' into a dict({'key': 'value'}) """
     try:
@@ -235,8 +619,62 @@ def run(cmd, env):
     # overlaid with our built environment
     environ = os.environ.copy()
     environ.update(env.to_dict())
-    # Use of undocumented 'env' option on check_output
-    return to_dict(check_output(cmd, shell=True, env=environ))
+    section = env['section'].value if 'section' in env else None
+    with timings.span('run', section):
+        # Use of undocumented 'env' option on check_output
+        output = check_output(cmd, shell=True, env=environ)
+    return to_dict(output)
+
+
+def run_cached(name, env, refresh=False):
+    """
+    Run the 'opt-cmd' or 'env-cmd' named and return the result. If the
+    section sets '<name>-ttl' the result is cached for that many seconds,
+    unless 'refresh' is True
+    """
+    cmd, path, ttl = cmd_cache(name, env)
+    if path is None:
+        return run(cmd, env)
+    if not refresh:
+        result = load_cached(path)
+        if result is not None:
+            return result
+    result = run(cmd, env)
+    cache.save(path, (time.time() + ttl, result))
+    return result
+
+
+def cmd_cache(name, env):
+    """
+    Return (cmd, path, ttl) for the 'opt-cmd' or 'env-cmd' named, where
+    path is where its output is cached for ttl seconds, or None if the
+    output is not cached
+    """
+    cmd = env[name].value
+    ttl = env.get(name + '-ttl')
+    if ttl is None or empty(ttl.value) or empty(cmd) or not cache.enabled():
+        return cmd, None, None
+    try:
+        ttl = int(ttl.value)
+    except ValueError:
+        raise RuntimeError("'%s-ttl' must be a number of seconds, got '%s'"
+                           % (name, ttl.value))
+
+    # Anything from the command line the command uses is
+    # already part of the expanded command
+    inputs = sorted('%s=%s' % (k, v) for k, v in env.to_dict().items()
+                    if not k.startswith('opt.'))
+    path = os.path.join(cache.cache_dir(), 'cmd',
+                        '%s.pickle' % cache.digest(cmd, *inputs))
+    return cmd, path, ttl
+
+
+def load_cached(path):
+    """ Return the cached output of a command or None if it expired """
+    entry = cache.load(path)
+    if entry is not None and entry[0] > time.time():
+        return entry[1]
+    return None
 
 
 def cmd_path(cmd, conf):
@@ -266,7 +704,9 @@ def eval_args(argv, conf, parser):
     return arg1, arg2, env
 
 
-def execute_environment(cmd, env, hubble_args, other_args):
+def prepare_environment(cmd, env, hubble_args, other_args):
+    """ Return the argv and environ to run 'cmd' with """
+    args = list(other_args)
     # If --debug; print out our env config and pass along the
     # --debug arg
     if hubble_args.debug:
@@ -274,44 +714,492 @@ def execute_environment(cmd, env, hubble_args, other_args):
         if cmd.endswith('cinder'):
             env.add({'CINDERCLIENT_DEBUG': '1'})
         print("%r\n" % env)
-        other_args.insert(0, '--debug')
+        args.insert(0, '--debug')
 
     # Grab a copy of the local environment and inject it into
     # our environment
     environ = os.environ.copy()
     environ.update(env.to_dict())
+    return [cmd] + args, environ
+
+
+def sh_quote(value):
+    return "'%s'" % value.replace("'", "'\\''")
+
+
+def fish_quote(value):
+    return "'%s'" % value.replace('\\', '\\\\').replace("'", "\\'")
+
 
+# How each --export-format writes a single variable
+EXPORT_FORMATS = {
+    'sh': lambda key, value: "export %s=%s\n" % (key, sh_quote(value)),
+    'fish': lambda key, value: "set -gx %s %s\n" % (key, fish_quote(value)),
+    'nul': lambda key, value: "%s=%s\0" % (key, value),
+}
+
+
+def export_environment(env, format='sh'):
+    """
+    Return the exported variables of 'env' as a script the shell named
+    by 'format' can source, or as NUL terminated key=value pairs
+    """
+    line = EXPORT_FORMATS[format]
+    items = sorted(env.to_dict().items())
+    if format != 'nul':
+        # Names like opt.env or opt-cmd are no use to a shell
+        items = [(k, v) for k, v in items if IDENTIFIER.match(k)]
+    return ''.join(line(key, value) for key, value in items)
+
+
+def exec_failed(cmd, e):
+    """ Return the RuntimeError to raise when 'cmd' could not be run """
+    if e.errno == errno.ENOENT:
+        print("-- No such executable '%s', you must specify the "
+              "executable in the [hubble-commands] section of the "
+              "config (See README)" % cmd)
+    return RuntimeError("exec failed '%s' - %s" % (cmd, e))
+
+
+def new_session():
+    """ Return the Popen() arguments that start a session of its own """
+    if sys.version_info[0] < 3:
+        return {'preexec_fn': os.setsid}
+    # Unlike preexec_fn this is safe with threads running
+    return {'start_new_session': True}
+
+
+def new_process_group():
+    """ Return the Popen() arguments that start a process group of its own """
+    if sys.version_info >= (3, 11):
+        return {'process_group': 0}
+    return {'preexec_fn': os.setpgrp}
+
+
+def set_foreground(pgrp):
+    """ Make 'pgrp' the foreground process group of our terminal """
+    try:
+        os.tcsetpgrp(sys.stdin.fileno(), pgrp)
+    except (AttributeError, ValueError, EnvironmentError):
+        pass
+
+
+def owns_terminal():
+    """ Return True if we are the foreground process group of a terminal """
+    try:
+        return os.tcgetpgrp(sys.stdin.fileno()) == os.getpgrp()
+    except (AttributeError, ValueError, EnvironmentError):
+        return False
+
+
+@contextmanager
+def terminal():
+    """
+    Let a command started in the 'foreground' have our terminal while it
+    runs, and take the terminal back once it is done
+    """
+    if not owns_terminal():
+        yield
+        return
+    # We are in the background while the command runs, which must not
+    # stop us writing its output or taking the terminal back
+    handler = signal.signal(signal.SIGTTOU, signal.SIG_IGN)
+    try:
+        yield
+    finally:
+        set_foreground(os.getpgrp())
+        signal.signal(signal.SIGTTOU, handler)
+
+
+def execute_environment(cmd, env, hubble_args, other_args,
+                        foreground=False):
+    """
+    Start the command with its output piped back to us. The command and
+    anything it starts are in a process group of their own so they can be
+    cleaned up together. A command run in the 'foreground' is handed our
+    terminal so it can prompt the user, the others run in a session of
+    their own
+    """
+    args, environ = prepare_environment(cmd, env, hubble_args, other_args)
+    kwargs = new_process_group() if foreground else new_session()
     try:
         # Run the requested command
-        p = Popen([cmd] + other_args,
-                  stdout=PIPE,
-                  stderr=PIPE,
-                  env=environ)
+        with timings.span('spawn', env['section'].value):
+            p = Popen(args, stdout=PIPE, stderr=PIPE, env=environ, **kwargs)
     except OSError as e:
-        if e.errno == 2:
-            print("-- No such executable '%s', you must specify the "
-                  "executable in the [hubble-commands] section of the "
-                  "config (See README)" % cmd.value)
-        message = "exec failed '%s' - %s" % (cmd.value, e)
-        raise RuntimeError(message)
-
+        raise exec_failed(cmd, e)
+    if foreground and owns_terminal():
+        set_foreground(p.pid)
+        # In case it read the terminal before it was handed over
+        os.killpg(p.pid, signal.SIGCONT)
     return p
 
 
+def exec_environment(cmd, env, hubble_args, other_args):
+    """
+    Replace hubble with the requested command, which inherits our stdin,
+    stdout, stderr and signals and whose exit code becomes ours
+    """
+    args, environ = prepare_environment(cmd, env, hubble_args, other_args)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    try:
+        os.execvpe(cmd, args, environ)
+    except OSError as e:
+        raise exec_failed(cmd, e)
+
+
+def can_exec(stdout, stderr):
+    """ Return True if our output goes straight to stdout and stderr """
+    try:
+        return stdout.fileno() == 1 and stderr.fileno() == 2
+    except (AttributeError, ValueError, EnvironmentError):
+        return False
+
+
+def get_parallel(hubble_args, conf):
+    """ Return how many meta commands may run at once, 0 is no limit """
+    value = getattr(hubble_args, 'parallel', None)
+    if value is None:
+        value = conf.safe_get(conf.default_section, 'meta-parallel') or 0
+    try:
+        return max(int(value), 0)
+    except ValueError:
+        raise RuntimeError("'meta-parallel' must be a number, got '%s'"
+                           % value)
+
+
+def get_timings(hubble_args):
+    """
+    Return how to report the timings of this run from --timings,
+    --timings-file or HUBBLE_TIMINGS, or None if we are not timing it
+    """
+    if getattr(hubble_args, 'timings_file', None):
+        return parse_spec(hubble_args.timings_file)
+    spec = parse_spec(os.environ.get('HUBBLE_TIMINGS'))
+    if getattr(hubble_args, 'timings', False):
+        return spec or 'table'
+    return spec
+
+
+def start_timings(hubble_args, start, read):
+    """
+    Start timing the run if asked to, 'start' is when we started reading
+    the config and 'read' how long that took. Returns the report spec
+    """
+    spec = get_timings(hubble_args)
+    if spec:
+        timings.enable(origin=start)
+        timings.add('read_configs', None, 0, read)
+    return spec
+
+
+def stop_timings(spec, stderr):
+    """ Report the timings if we were timing the run """
+    if timings.enabled:
+        timings.disable()
+        timings.report(spec, stderr)
+
+
+def export_environments(choice, environments, hubble_args, stdout):
+    """ Print the environment for the shell instead of running a command """
+    if len(environments) != 1:
+        raise RuntimeError("--export needs a single environment, "
+                           "[%s] is a meta section" % choice)
+    stdout.write(export_environment(environments[0],
+                                    hubble_args.export_format))
+    stdout.flush()
+    return 0
+
+
+@contextmanager
+def interruptible():
+    """
+    Treat SIGTERM and SIGHUP like Ctrl-C while commands run, so we clean
+    up their process groups rather than leave them behind
+    """
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt()
+    previous = {}
+    try:
+        for signum in (signal.SIGTERM, signal.SIGHUP):
+            previous[signum] = signal.signal(signum, interrupt)
+    except ValueError:
+        # Signals can only be handled in the main thread
+        pass
+    try:
+        yield
+    finally:
+        for signum, handler in previous.items():
+            signal.signal(signum, handler)
+
+
+def get_spool_size(conf):
+    """
+    Return how many bytes of held back output to keep in memory before
+    spilling it to disk, from 'spool-size' which may end in K, M or G
+    """
+    from hubble.output import SPOOL_SIZE
+    value = conf.safe_get(conf.default_section, 'spool-size')
+    if empty(value):
+        return SPOOL_SIZE
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    number, unit = value.strip(), 1
+    if number[-1:].upper() in units:
+        number, unit = number[:-1], units[number[-1].upper()]
+    try:
+        return int(number) * unit
+    except ValueError:
+        raise RuntimeError("'spool-size' must be a number of bytes, "
+                           "got '%s'" % value)
+
+
+def get_timeout(hubble_args, env):
+    """ Return how many seconds the command may run for, or None """
+    value = getattr(hubble_args, 'timeout', None)
+    if value is None and 'cmd-timeout' in env:
+        value = env['cmd-timeout'].value
+    if value is None or empty(str(value)):
+        return None
+    try:
+        return float(value) or None
+    except ValueError:
+        raise RuntimeError("'cmd-timeout' must be a number of seconds, "
+                           "got '%s'" % value)
+
+
+def get_cache_ttl(hubble_args, env):
+    """
+    Return how many seconds the output of the command is cached for, or
+    None if it isn't
+    """
+    value = getattr(hubble_args, 'cache_output', None)
+    if value is None and 'cache-output' in env:
+        value = env['cache-output'].value
+    if value is None or empty(str(value)) or not cache.enabled():
+        return None
+    try:
+        return int(value) or None
+    except ValueError:
+        raise RuntimeError("'cache-output' must be a number of seconds, "
+                           "got '%s'" % value)
+
+
+def which(cmd):
+    """ Return the absolute path the command would be run from """
+    if os.sep in cmd:
+        return os.path.abspath(cmd)
+    for path in os.environ.get('PATH', os.defpath).split(os.pathsep):
+        candidate = os.path.join(path, cmd)
+        if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+            return os.path.abspath(candidate)
+    return cmd
+
+
+def output_cache(cmd, env, hubble_args, other_args):
+    """
+    Return the OutputCache() of the command, keyed on where the command
+    lives, its arguments and the environment it sees, or None if the
+    output of the command is not cached
+    """
+    ttl = get_cache_ttl(hubble_args, env)
+    # --debug changes the arguments and prints the environment
+    if ttl is None or hubble_args.debug:
+        return None
+    from hubble.output import OutputCache
+    # The argument count keeps an argument from passing for a variable
+    parts = [which(cmd), str(len(other_args))] + list(other_args)
+    # Anything from the command line the command uses is already in
+    # the arguments or the variables it expanded into
+    parts += sorted('%s=%s' % (k, v) for k, v in env.to_dict().items()
+                    if not k.startswith('opt.'))
+    path = os.path.join(cache.cache_dir(), 'output',
+                        '%s.pickle' % cache.digest(*parts))
+    return OutputCache(path, ttl)
+
+
+def make_job(name, cmd, env, hubble_args, other_args, foreground=False):
+    """
+    Return the (name, start, timeout, output_cache) job that runs 'cmd'
+    in the environment, or replays its cached output
+    """
+    output = output_cache(cmd, env, hubble_args, other_args)
+    if output is not None and not hubble_args.refresh:
+        replay = output.load()
+        if replay is not None:
+            return name, lambda: replay, None, None
+    # Create the selected environment to execute our command in
+    # once the scheduler has a free slot
+    start = partial(execute_environment, cmd, env, hubble_args, other_args,
+                    foreground)
+    return name, start, get_timeout(hubble_args, env), output
+
+
+def run_environments(argv, conf, environments, hubble_args, other_args,
+                     stdout, stderr):
+    """
+    Run the command in each environment and stream the output. Returns a
+    list of (section, returncode)
+    """
+    records = getattr(hubble_args, 'format', 'text') == 'jsonl'
+    # A single environment has no need for us to stick around, unless
+    # we are timing the run, reporting on it or enforcing a deadline
+    meta = len(environments) != 1
+    if not meta and not records and can_exec(stdout, stderr) \
+            and not timings.enabled \
+            and get_timeout(hubble_args, environments[0]) is None \
+            and get_cache_ttl(hubble_args, environments[0]) is None:
+        env = environments[0]
+        exec_environment(get_cmd(argv, conf, env, hubble_args), env,
+                         hubble_args, other_args)
+
+    jobs = []
+    for env in environments:
+        # Get the command to execute
+        cmd = get_cmd(argv, conf, env, hubble_args)
+        # A lone command keeps the terminal so it can prompt the user
+        jobs.append(make_job(env['section'].value, cmd, env, hubble_args,
+                             other_args, foreground=not meta))
+    # A meta section gets either headers or a per-line prefix
+    with terminal():
+        return run_jobs(jobs, conf, hubble_args, stdout, stderr,
+                        get_parallel(hubble_args, conf), labels=meta)
+
+
+def run_jobs(jobs, conf, hubble_args, stdout, stderr, parallel, labels):
+    """
+    Run the (name, start, timeout, output_cache) jobs and stream their
+    output, with a header or prefix naming each job if 'labels' is True.
+    Returns a list of (name, returncode)
+    """
+    from hubble.output import Multiplexer
+    from hubble.scheduler import Scheduler
+
+    records = getattr(hubble_args, 'format', 'text') == 'jsonl'
+    mux = Multiplexer(stdout, stderr,
+                      headers=labels and not hubble_args.prefix,
+                      prefix=labels and hubble_args.prefix, records=records,
+                      spool_size=get_spool_size(conf))
+    scheduler = Scheduler(mux, parallel,
+                          getattr(hubble_args, 'fail_fast', False))
+    with interruptible():
+        return scheduler.run(jobs)
+
+
+def read_batch(path):
+    """
+    Return the (line number, environment, args) of each command in the
+    batch file 'path', or of stdin if 'path' is '-'
+    """
+    import shlex
+    try:
+        if path == '-':
+            lines = sys.stdin.read().splitlines()
+        else:
+            with open(path) as fd:
+                lines = fd.read().splitlines()
+    except (IOError, OSError) as e:
+        raise RuntimeError("unable to read batch file '%s' - %s" % (path, e))
+
+    commands = []
+    for number, line in enumerate(lines, 1):
+        try:
+            words = shlex.split(line, comments=True)
+        except ValueError as e:
+            raise RuntimeError("%s line %d: %s" % (path, number, e))
+        if words:
+            commands.append((number, words[0], words[1:]))
+    return commands
+
+
+def run_batch(argv, conf, hubble_args, other_args, files, stdout, stderr):
+    """
+    Run the command on each line of the --batch file. Every environment
+    named is resolved once, before any command runs, and shared by the
+    lines that name it. Returns a list of ('section:line', returncode)
+    """
+    if other_args or getattr(hubble_args, 'env', None):
+        raise RuntimeError("--batch reads the environment and arguments "
+                           "from each line of '%s'" % hubble_args.batch)
+    commands = read_batch(hubble_args.batch)
+    environments = {}
+    for number, choice, _ in commands:
+        if choice in environments:
+            continue
+        try:
+            environments[choice] = resolve_environments(hubble_args, choice,
+                                                        conf, files)
+        except NoSectionError:
+            raise RuntimeError("line %d: no such environment [%s]"
+                               % (number, choice))
+
+    jobs = []
+    for number, choice, args in commands:
+        for env in environments[choice]:
+            jobs.append(make_job('%s:%d' % (env['section'].value, number),
+                                 get_cmd(argv, conf, env, hubble_args), env,
+                                 hubble_args, args))
+    # The lines run in order unless --parallel says otherwise
+    parallel = 1 if hubble_args.parallel is None else max(
+        hubble_args.parallel, 0)
+    results = run_jobs(jobs, conf, hubble_args, stdout, stderr, parallel,
+                       labels=True)
+    if hubble_args.format != 'jsonl':
+        report_batch(results, len(jobs), stderr)
+    return results
+
+
+def report_batch(results, total, stderr):
+    """ Tell the user which lines of the batch failed or never ran """
+    for name, code in results:
+        if code:
+            stderr.write("-- [%s] exited with %d\n" % (name, code))
+    if len(results) < total:
+        stderr.write("-- %d of %d commands were not run\n"
+                     % (total - len(results), total))
+    stderr.flush()
+
+
+def exit_status(results):
+    """
+    Return our exit code for the (section, returncode) results, the
+    commands own exit code if there was only one, else 1 if any failed
+    """
+    codes = [code for _, code in results]
+    code = codes[0] if len(codes) == 1 else int(any(codes))
+    # Report a command killed by a signal the way a shell would
+    return 128 - code if code < 0 else code
+
+
+def run_choice(argv, conf, choice, hubble_args, other_args, files, stdout,
+               stderr):
+    """ Do what the command line asked for and return our exit code """
+    if hubble_args.batch:
+        return exit_status(run_batch(argv, conf, hubble_args, other_args,
+                                     files, stdout, stderr))
+    # Collect all environments from our config file
+    environments = resolve_environments(hubble_args, choice, conf, files)
+    if hubble_args.export:
+        return export_environments(choice, environments, hubble_args, stdout)
+    return exit_status(run_environments(argv, conf, environments,
+                                        hubble_args, other_args, stdout,
+                                        stderr))
+
+
 def main(argv=sys.argv, stdout=sys.stdout, stderr=sys.stderr, files=None):
     logging.basicConfig(format='-- %(message)s')
     log.setLevel(logging.CRITICAL)
     formatter_class = argparse.RawDescriptionHelpFormatter
     parser = argparse.ArgumentParser(add_help=False,
                                      formatter_class=formatter_class,
-                                     description=textwrap.dedent("""\
-            Hubble - An environment variable manager for tools like
-            cinderclient, novaclient, swiftclient and swiftly that rely
-            on environment variables for configuration.
-
-            Use ~/.hubblerc for user wide environments then place a
-            .hubblerc in a local directory to override ~/.hubblerc
-            """))
+                                     description="""\
+Hubble - An environment variable manager for tools like
+cinderclient, novaclient, swiftclient and swiftly that rely
+on environment variables for configuration.
+
+Use ~/.hubblerc for user wide environments then place a
+.hubblerc in a local directory to override ~/.hubblerc
+""")
     parser.add_argument('-o', '--option',
                         help="an argument to pass to the opt-cmd")
     parser.add_argument('-e', '--execute', metavar='COMMAND',
@@ -321,48 +1209,86 @@ def main(argv=sys.argv, stdout=sys.stdout, stderr=sys.stderr, files=None):
     parser.add_argument('-d', '--debug', action='store_true',
                         help="Adds CINDERCLIENT_DEBUG=1 to the environment "
                         "and passes --debug to selected command")
+    parser.add_argument('--prefix', action='store_true',
+                        help="tag every line of output from a meta section "
+                        "with [section] instead of printing headers")
+    parser.add_argument('--refresh', action='store_true',
+                        help="run the opt-cmd and env-cmd even if their "
+                        "output is cached")
+    parser.add_argument('--parallel', metavar='N', type=int,
+                        help="run at most N commands of a meta section at "
+                        "once (default 'meta-parallel' or no limit)")
+    parser.add_argument('--fail-fast', action='store_true',
+                        help="stop the commands of a meta section as soon "
+                        "as one of them fails")
+    parser.add_argument('--timeout', metavar='SECONDS', type=float,
+                        help="stop a command that runs longer than SECONDS "
+                        "(default 'cmd-timeout' or no limit)")
+    parser.add_argument('--cache-output', metavar='TTL', type=int,
+                        help="replay the output of a command that succeeded "
+                        "in the last TTL seconds instead of running it again "
+                        "(default 'cache-output' or never)")
+    parser.add_argument('--format', choices=['text', 'jsonl'],
+                        default='text',
+                        help="jsonl writes a JSON record with the exit code, "
+                        "timing and output of each section as it finishes")
+    parser.add_argument('--export', action='store_true',
+                        help="print the environment as a script to source "
+                        "or eval instead of running a command")
+    parser.add_argument('--export-format', default='sh',
+                        choices=sorted(EXPORT_FORMATS),
+                        help="sh for bash and zsh (the default), fish, or "
+                        "nul for NUL terminated key=value pairs")
+    parser.add_argument('--batch', metavar='FILE',
+                        help="run the '<ENV> <args...>' on each line of "
+                        "FILE, or stdin if FILE is -, resolving each "
+                        "environment once")
+    parser.add_argument('--timings', action='store_true',
+                        help="print how long each phase of the run took "
+                        "to stderr")
+    parser.add_argument('--timings-file', metavar='SPEC',
+                        help="write the timings to a file instead, SPEC is "
+                        "json:PATH or trace:PATH for a Chrome trace")
 
-    # Read the configs
-    conf = read_configs(files=files, default_section='hubble')
-    # Evaluate the command line arguments and return our args
-    # the commands args and the environment choice the user made
-    hubble_args, other_args, choice = eval_args(argv, conf, parser)
-    # Do this so we pass along the -h to the command
-    # if we are using invocation discovery
-    if hubble_args.help and (choice is None):
-        return parser.print_help()
-
-    # If there was an error
-    if conf.get_error():
-        print(conf.get_error())
-        return 1
+    spec = None
+    try:
+        # Read the configs, we don't know if we are
+        # timing the run until the args are parsed
+        start = clock()
+        conf = read_configs(files=files, default_section='hubble')
+        read = clock() - start
+        # Evaluate the command line arguments and return our args
+        # the commands args and the environment choice the user made
+        hubble_args, other_args, choice = eval_args(argv, conf, parser)
+        # Do this so we pass along the -h to the command
+        # if we are using invocation discovery
+        if hubble_args.help and (choice is None):
+            return parser.print_help()
 
-    if choice is None:
-        print("Environments Configured: %s" % ",".join(conf.sections()))
-        print("See --help for usage")
-        return 1
-    if hubble_args.help:
-        other_args.append('--help')
+        # If there was an error
+        if conf.get_error():
+            print(conf.get_error())
+            return 1
 
-    # Set our log level
-    if hubble_args.debug:
-        log.setLevel(logging.DEBUG)
+        if choice is None and not hubble_args.batch:
+            print("Environments Configured: %s" % ",".join(conf.sections()))
+            print("See --help for usage")
+            return 1
+        if hubble_args.help:
+            other_args.append('--help')
 
-    # Collect all environments from our config file
-    environments = get_environments(hubble_args, choice, conf)
-    processes = []
-    for env in environments:
-        # Get the command to execute
-        cmd = get_cmd(argv, conf, env, hubble_args)
-        # Create the selected environment to execute our command in
-        p = execute_environment(cmd, env, hubble_args, other_args)
-        processes.append((p, env['section'].value))
-
-    for p, env in processes:
-        if len(environments) != 1:
-            print("-- [%s] --" % green(env))
-        # Wait for the command to complete
-        out, err = p.communicate()
-        stdout.write(out.decode('utf-8'))
-        stderr.write(err.decode('utf-8'))
-    return 0
+        # Set our log level
+        if hubble_args.debug:
+            log.setLevel(logging.DEBUG)
+
+        spec = start_timings(hubble_args, start, read)
+        return run_choice(argv, conf, choice, hubble_args, other_args,
+                          files, stdout, stderr)
+    except (RuntimeError, NoSectionError) as e:
+        # A section that inherits from one that doesn't exist
+        print("-- %s" % str(e))
+        return 1
+    except KeyboardInterrupt:
+        return 128 + signal.SIGINT
+    finally:
+        stop_timings(spec, stderr)
@@ -13,10 +13,16 @@
 #   limitations under the License.
 
 from io import StringIO
+import json
 import os
+import shutil
+from subprocess import check_output, PIPE, Popen
+import sys
 import tempfile
+import time
 import unittest
 
+import hubble
 from hubble.shell import main
 
 
@@ -71,3 +77,213 @@ class TestHubble(unittest.TestCase):
         self.assertEqual(ret, 0)
         self.assertEqual(out['SOME'], "Thing")
         self.assertEqual(out['opt-injected-key'], "value")
+
+    def test_exec(self):
+        home = tempfile.mkdtemp()
+        try:
+            cmd = generate_test_cmd("import sys\n"
+                                    "print(os.getpid())\n"
+                                    "sys.exit(int(os.environ['CODE']))")
+            with open(os.path.join(home, '.hubblerc'), 'w') as fd:
+                fd.write("[dfw]\ncmd=%s\nCODE=7\n" % cmd)
+            environ = dict(os.environ, HOME=home, HUBBLE_NO_CACHE='1',
+                           PYTHONPATH=os.path.dirname(hubble.__path__[0]))
+            p = Popen([sys.executable, '-c', 'import sys; '
+                       'from hubble.shell import main; '
+                       'sys.exit(main(["hubble"] + sys.argv[1:]))',
+                       'dfw'], stdout=PIPE, cwd=home, env=environ)
+            out, _ = p.communicate()
+            os.unlink(cmd)
+        finally:
+            shutil.rmtree(home)
+        # The command replaced the hubble process
+        self.assertEqual(int(out), p.pid)
+        self.assertEqual(p.returncode, 7)
+
+    def export(self, fmt):
+        config = StringIO(u"[dfw]\n"
+                          "cmd=/bin/false\n"
+                          "TRICKY=it's a $HOME \\ `date` \"test\"\n"
+                          "NAME=${section}\n")
+        config.name = "test.conf"
+        stdout = StringIO()
+        ret = main(["hubble", "--export", "--export-format", fmt, "dfw"],
+                   stdout=stdout, stderr=StringIO(), files=[config])
+        self.assertEqual(ret, 0)
+        return stdout.getvalue()
+
+    def test_export(self):
+        script = self.export('sh')
+        self.assertNotIn('opt.', script)
+        out = check_output(['sh', '-c', 'eval "$1"; printf "%s|%s" '
+                            '"$TRICKY" "$NAME"', 'sh', script])
+        self.assertEqual(out.decode('utf-8'),
+                         'it\'s a $HOME \\ `date` "test"|dfw')
+
+    def test_export_formats(self):
+        self.assertIn("set -gx TRICKY 'it\\'s a $HOME \\\\ `date` "
+                      "\"test\"'\n", self.export('fish'))
+        pairs = self.export('nul').split('\0')
+        self.assertIn('NAME=dfw', pairs)
+        self.assertIn('opt.env=dfw', pairs)
+
+    def test_jsonl(self):
+        config = StringIO(u"[all]\n"
+                          "meta=['dfw', 'ord']\n"
+                          "[dfw]\n"
+                          "CODE=0\n"
+                          "[ord]\n"
+                          "CODE=3\n")
+        config.name = "test.conf"
+        stdout = StringIO()
+        ret = main(["hubble", "--format", "jsonl", "-e", "sh", "all", "-c",
+                    "echo $CODE; exit $CODE"],
+                   stdout=stdout, stderr=StringIO(), files=[config])
+        records = sorted((json.loads(line) for line in
+                          stdout.getvalue().splitlines()),
+                         key=lambda r: r['section'])
+        self.assertEqual([(r['section'], r['returncode'], r['stdout'])
+                          for r in records],
+                         [('dfw', 0, '0\n'), ('ord', 3, '3\n')])
+        # Any failure fails the run
+        self.assertEqual(ret, 1)
+
+    def test_cmd_timeout(self):
+        config = StringIO(u"[dfw]\n"
+                          "cmd-timeout=0.2\n")
+        config.name = "test.conf"
+        stdout = StringIO()
+        ret = main(["hubble", "--format", "jsonl", "-e", "sleep", "dfw",
+                    "30"], stdout=stdout, stderr=StringIO(), files=[config])
+        record = json.loads(stdout.getvalue())
+        self.assertTrue(record['timed_out'])
+        self.assertEqual(ret, 128 + 15)
+
+    def test_batch(self):
+        tmp = tempfile.mkdtemp()
+        try:
+            counter = os.path.join(tmp, 'counter')
+            batch = os.path.join(tmp, 'batch')
+            with open(batch, 'w') as fd:
+                fd.write("# Comments and blank lines are skipped\n\n"
+                         "dfw -c 'echo $FOO one'\n"
+                         "ord -c 'echo $FOO two; exit 3'\n"
+                         "dfw -c 'echo $FOO three'  # again\n")
+            config = StringIO(u"[hubble]\n"
+                              "env-cmd=echo run >> %s; echo FOO=${section}\n"
+                              "[dfw]\n"
+                              "[ord]\n" % counter)
+            config.name = "test.conf"
+            stdout = StringIO()
+            ret = main(["hubble", "--format", "jsonl", "-e", "sh",
+                        "--batch", batch], stdout=stdout, stderr=StringIO(),
+                       files=[config])
+            with open(counter) as fd:
+                runs = fd.read().split()
+        finally:
+            shutil.rmtree(tmp)
+        records = [json.loads(line) for line in
+                   stdout.getvalue().splitlines()]
+        # Lines run in order by default
+        self.assertEqual([(r['section'], r['returncode'], r['stdout'])
+                          for r in records],
+                         [('dfw:3', 0, 'dfw one\n'), ('ord:4', 3, 'ord two\n'),
+                          ('dfw:5', 0, 'dfw three\n')])
+        # Each environment was resolved once
+        self.assertEqual(runs, ['run', 'run'])
+        self.assertEqual(ret, 1)
+
+    def test_process_groups(self):
+        config = StringIO(u"[dfw]\n[ord]\n[all]\nmeta=['dfw', 'ord']\n")
+        config.name = "test.conf"
+        code = "import os; print(os.getpid(), os.getpgrp(), os.getsid(0))"
+
+        def run(choice):
+            stdout = StringIO()
+            main(["hubble", "--format", "jsonl", choice, "-e",
+                  sys.executable, "-c", code], stdout=stdout,
+                 stderr=StringIO(), files=[config])
+            config.seek(0)
+            return [tuple(int(i) for i in json.loads(line)['stdout'].split())
+                    for line in stdout.getvalue().splitlines()]
+
+        # A lone command leads a process group in our session, so it
+        # can be handed the terminal
+        (pid, pgrp, sid), = run('dfw')
+        self.assertEqual((pgrp, sid), (pid, os.getsid(0)))
+        # while the commands of a meta section lead their own session
+        for pid, pgrp, sid in run('all'):
+            self.assertEqual((pgrp, sid), (pid, pid))
+
+    def test_timeout_kills_grandchildren(self):
+        config = StringIO(u"[dfw]\n")
+        config.name = "test.conf"
+        start = time.time()
+        # The grandchild holds on to the output pipes
+        ret = main(["hubble", "--timeout", "0.5", "dfw", "-e", "sh", "-c",
+                    "sleep 30 & sleep 30"], stdout=StringIO(),
+                   stderr=StringIO(), files=[config])
+        self.assertLess(time.time() - start, 10)
+        self.assertNotEqual(ret, 0)
+
+    def test_broken_section(self):
+        tmp = tempfile.mkdtemp()
+        os.environ['HUBBLE_CACHE_DIR'] = os.path.join(tmp, 'cache')
+        path = os.path.join(tmp, 'hubblerc')
+        with open(path, 'w') as fd:
+            fd.write(u"[dfw]\nFOO=dfw\n[ord]\n%inherit=missing\n")
+        try:
+            stdout = StringIO()
+            # Only the section that inherits from nothing is broken
+            ret = main(["hubble", "dfw", "-e", "sh", "-c", "echo $FOO"],
+                       stdout=stdout, stderr=StringIO(), files=[path])
+            self.assertEqual((ret, stdout.getvalue()), (0, "dfw\n"))
+            ret = main(["hubble", "ord", "-e", "true"], stdout=StringIO(),
+                       stderr=StringIO(), files=[path])
+            self.assertEqual(ret, 1)
+        finally:
+            del os.environ['HUBBLE_CACHE_DIR']
+            shutil.rmtree(tmp)
+
+    def test_cache_output(self):
+        tmp = tempfile.mkdtemp()
+        os.environ['HUBBLE_CACHE_DIR'] = os.path.join(tmp, 'cache')
+        counter = os.path.join(tmp, 'counter')
+
+        def run(code, *args):
+            config = StringIO(u"[hubble]\n"
+                              "cache-output=60\n"
+                              "[dfw]\n"
+                              "FOO=dfw\n")
+            config.name = "test.conf"
+            stdout = StringIO()
+            argv = ["hubble", "--format", "jsonl"] + list(args)
+            argv += ["dfw", "-e", "sh", "-c",
+                     "echo run >> %s; echo $FOO $(wc -l < %s); exit $0"
+                     % (counter, counter), code]
+            ret = main(argv, stdout=stdout, stderr=StringIO(),
+                       files=[config])
+            record = json.loads(stdout.getvalue())
+            return ret, record['stdout'].split(), record['cached']
+
+        try:
+            self.assertEqual(run('0'), (0, ['dfw', '1'], False))
+            # Replayed until it expires
+            self.assertEqual(run('0'), (0, ['dfw', '1'], True))
+            # Other arguments are a different command
+            self.assertEqual(run('1'), (1, ['dfw', '2'], False))
+            # and failures are not cached
+            self.assertEqual(run('1'), (1, ['dfw', '3'], False))
+            self.assertEqual(run('0', '--refresh'), (0, ['dfw', '4'], False))
+            # --refresh replaced what the next run replays
+            self.assertEqual(run('0'), (0, ['dfw', '4'], True))
+            # The flag and the setting share the entry
+            self.assertEqual(run('0', '--cache-output', '60'),
+                             (0, ['dfw', '4'], True))
+            self.assertEqual(run('0', '--cache-output', '0'),
+                             (0, ['dfw', '5'], False))
+            self.assertEqual(len(os.listdir(os.path.join(tmp, 'cache',
+                                                         'output'))), 1)
+        finally:
+            del os.environ['HUBBLE_CACHE_DIR']
+            shutil.rmtree(tmp)
@@ -0,0 +1,4 @@
+import sys
+
+# The asyncio engine needs python 3.7 or later
+collect_ignore = ['test_engine.py'] if sys.version_info < (3, 7) else []
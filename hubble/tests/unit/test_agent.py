@@ -0,0 +1,160 @@
+import argparse
+from configparser import NoSectionError
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from hubble import agent
+from hubble import cache
+from hubble import keys
+from hubble.agent import Agent
+from hubble.config import read_configs
+from hubble.shell import resolve_environments
+
+
+class TestAgent(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ['HUBBLE_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+        os.environ['HUBBLE_AGENT_SOCK'] = os.path.join(self.dir, 'run',
+                                                       'agent.sock')
+        os.environ.pop('HUBBLE_NO_AGENT', None)
+        self.rc = os.path.join(self.dir, 'hubblerc')
+        self.write(u"[dfw]\n"
+                   "name=${FIRST} ${last}\n"
+                   "FIRST=Derrick\n"
+                   "last=Wippler\n"
+                   "[ord]\n"
+                   "env-cmd=echo CALLER=$CALLER\n"
+                   "[all]\n"
+                   "meta=['dfw', 'ord']\n")
+        self.args = argparse.Namespace(env='dfw', option=None, refresh=False)
+
+    def tearDown(self):
+        agent.request({'op': 'stop'})
+        if hasattr(self, 'thread'):
+            self.thread.join()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def write(self, text):
+        with open(self.rc, 'w') as fd:
+            fd.write(text)
+        # Make sure the mtime changes when we write again
+        os.utime(self.rc, (time.time() - 10, time.time() - 10))
+
+    def start(self):
+        server = Agent(agent.socket_path())
+        self.thread = threading.Thread(target=server.serve)
+        self.thread.start()
+        for _ in range(100):
+            if os.path.exists(agent.socket_path()):
+                return server
+            time.sleep(0.01)
+        self.fail("agent did not start")
+
+    def test_runtime_dir(self):
+        del os.environ['HUBBLE_AGENT_SOCK']
+        os.environ['XDG_RUNTIME_DIR'] = self.dir
+        runtime = os.path.join(self.dir, 'hubble')
+        self.assertEqual(cache.runtime_dir(), runtime)
+        # Next to the keyring session cache
+        self.assertEqual(agent.socket_path(),
+                         os.path.join(runtime, 'agent.sock'))
+        self.assertEqual(keys.session_path(),
+                         os.path.join(runtime, 'keyring.json'))
+
+    def test_no_agent(self):
+        self.assertIsNone(agent.resolve(self.args, 'dfw', [self.rc]))
+
+    def test_resolve(self):
+        self.start()
+        env, = agent.resolve(self.args, 'dfw', [self.rc])
+        self.assertEqual(env['name'].value, 'Derrick Wippler')
+        self.assertEqual(env['section'].value, 'dfw')
+        self.assertEqual(env['opt.env'].value, 'dfw')
+
+    def test_commands_are_left_to_hubble(self):
+        self.start()
+        os.environ['CALLER'] = 'me'
+        envs = agent.resolve(self.args, 'all', [self.rc])
+        self.assertEqual([env['section'].value for env in envs],
+                         ['dfw', 'ord'])
+        self.assertNotIn('CALLER', envs[1])
+        # hubble runs the env-cmd in its own environment
+        conf = read_configs([self.rc], default_section='hubble')
+        envs = resolve_environments(self.args, 'all', conf, [self.rc])
+        self.assertEqual(envs[1]['CALLER'].value, 'me')
+        self.assertNotIn('CALLER', envs[0])
+
+    def test_config_changes(self):
+        self.start()
+        env, = agent.resolve(self.args, 'dfw', [self.rc])
+        self.assertEqual(env['name'].value, 'Derrick Wippler')
+        self.write(u"[dfw]\nname=${FIRST}\nFIRST=Thrawn\n")
+        env, = agent.resolve(self.args, 'dfw', [self.rc])
+        self.assertEqual(env['name'].value, 'Thrawn')
+
+    def test_errors(self):
+        self.start()
+        # Raised just as it is without an agent
+        with self.assertRaises(NoSectionError) as cm:
+            agent.resolve(self.args, 'missing', [self.rc])
+        self.assertEqual(cm.exception.section, 'missing')
+        with self.assertRaises(RuntimeError) as cm:
+            agent.resolve(self.args, 'dfw', [os.path.join(self.dir, 'no')])
+        self.assertIn('Unable to find config', str(cm.exception))
+        # The agent is still answering
+        self.assertEqual(len(agent.resolve(self.args, 'dfw', [self.rc])), 1)
+
+    def test_socket_is_private(self):
+        self.start()
+        path = agent.socket_path()
+        self.assertEqual(os.stat(os.path.dirname(path)).st_mode & 0o077, 0)
+        self.assertEqual(os.stat(path).st_mode & 0o077, 0)
+
+    def test_slow_agent(self):
+        # Once the agent has the request we wait for its answer
+        path = agent.socket_path()
+        os.makedirs(os.path.dirname(path), 0o700)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+
+        def answer():
+            conn, _ = server.accept()
+            conn.makefile('rb').readline()
+            time.sleep(0.5)
+            conn.sendall(b'{"environments": []}\n')
+            conn.close()
+        thread = threading.Thread(target=answer)
+        thread.start()
+        timeout, agent.CONNECT_TIMEOUT = agent.CONNECT_TIMEOUT, 0.2
+        try:
+            self.assertEqual(agent.resolve(self.args, 'dfw', [self.rc]), [])
+        finally:
+            agent.CONNECT_TIMEOUT = timeout
+            thread.join()
+            server.close()
+            os.unlink(path)
+
+    def test_silent_client(self):
+        timeout, agent.REQUEST_TIMEOUT = agent.REQUEST_TIMEOUT, 0.2
+        try:
+            self.start()
+            # Connects and never sends a request
+            silent = agent.connect(agent.socket_path())
+            self.assertIsNotNone(silent)
+            try:
+                env, = agent.resolve(self.args, 'dfw', [self.rc])
+            finally:
+                silent.close()
+        finally:
+            agent.REQUEST_TIMEOUT = timeout
+        self.assertEqual(env['section'].value, 'dfw')
@@ -1,3 +1,7 @@
+from io import StringIO
+import os
+import shutil
+import tempfile
 import unittest
 
 from hubble import config
@@ -57,3 +61,211 @@ class TestInheritance(TestCase):
         self.assertEquals(d_spam, 'foo')
         e_spam = self.config.get('e', 'spam')
         self.assertEquals(e_spam, 'foo')
+
+    def test_diamond_inheritance(self):
+        self.config.read_string(u"[f]\n%inherit =\n  c\n  d\n")
+        self.assertEqual(self.config._supersections('f'), ['c', 'd', 'a'])
+        self.assertEqual(self.config.get('f', 'spam'), 'foo')
+
+    def test_inheritance_cycle(self):
+        self.config.read_string(u"[x]\n%inherit = y\n[y]\n%inherit = x\n")
+        with self.assertRaises(RuntimeError) as cm:
+            self.config.items('x')
+        self.assertIn('x -> y -> x', str(cm.exception))
+
+    def test_changes_invalidate(self):
+        self.assertEqual(self.config.get('e', 'a'), '1')
+        self.config.set('a', 'a', '10')
+        self.assertEqual(self.config.get('e', 'a'), '10')
+        self.config.remove_option('d', 'spam')
+        self.assertEqual(self.config.get('e', 'spam'), 'bar')
+
+
+class TestCompiledConfig(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ['HUBBLE_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+        self.path = os.path.join(self.dir, 'hubblerc')
+        fake_configs.fake_inheritance_config(self.write)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def write(self, config_string):
+        with open(self.path, 'w') as fd:
+            fd.write(config_string)
+
+    def read(self):
+        return config.read_configs([self.path], default_section='hubble')
+
+    def test_compiled_matches_parsed(self):
+        parsed = config.parse_configs([open(self.path)], 'hubble')
+        compiled = self.read()
+        self.assertIsInstance(compiled, config.CompiledConfigParser)
+        self.assertEqual(compiled.sections(), parsed.sections())
+        for section in parsed.sections() + ['hubble']:
+            self.assertEqual(compiled.items(section), parsed.items(section))
+        self.assertEqual(compiled.get('e', 'a'), '1')
+        self.assertEqual(compiled.safe_get('e', 'missing'), None)
+        self.assertEqual(compiled.section_index().names,
+                         parsed.section_index().names)
+
+    def test_warm_start_skips_parsing(self):
+        self.read()
+        parse_configs = config.parse_configs
+        config.parse_configs = None
+        try:
+            self.assertEqual(self.read().get('d', 'spam'), 'foo')
+        finally:
+            config.parse_configs = parse_configs
+
+    def test_rebuilds_on_change(self):
+        self.assertEqual(self.read().get('d', 'spam'), 'foo')
+        self.write(u"[hubble]\n[d]\nspam = bar\n")
+        self.assertEqual(self.read().get('d', 'spam'), 'bar')
+
+    def test_broken_sections_fail_when_used(self):
+        self.write(u"[hubble]\n[ok]\nspam = foo\n"
+                   "[orphan]\n%inherit = missing\n"
+                   "[x]\n%inherit = y\n[y]\n%inherit = x\n")
+        # Once when compiling and again from the cache
+        for _ in range(2):
+            conf = self.read()
+            self.assertEqual(conf.get('ok', 'spam'), 'foo')
+            self.assertEqual(conf.section_index().select('o*'),
+                             ['ok', 'orphan'])
+            with self.assertRaises(config.NoSectionError):
+                conf.section_items('orphan')
+            with self.assertRaises(RuntimeError) as cm:
+                conf.items('x')
+            self.assertIn('x -> y -> x', str(cm.exception))
+
+
+class TestIncludes(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ['HUBBLE_CACHE_DIR'] = os.path.join(self.dir, 'cache')
+        os.environ['HOME'] = self.dir
+        os.mkdir(os.path.join(self.dir, '.hubblerc.d'))
+        self.write('.hubblerc', u"[hubble]\nuser=home\n[dfw]\nregion=dfw\n")
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def write(self, name, config_string):
+        with open(os.path.join(self.dir, name), 'w') as fd:
+            fd.write(config_string)
+
+    def read(self):
+        # Everything but the ./.hubblerc of whoever runs the tests
+        files = config.default_files()[:-1]
+        return config.read_configs(files, default_section='hubble')
+
+    def test_fragments_override_in_order(self):
+        self.write('.hubblerc.d/20-b.conf', u"[dfw]\nregion=b\n")
+        self.write('.hubblerc.d/10-a.conf', u"[dfw]\nregion=a\nx=a\n")
+        self.write('.hubblerc.d/ignored', u"[dfw]\nregion=ignored\n")
+        conf = self.read()
+        self.assertEqual(conf.get('dfw', 'region'), 'b')
+        self.assertEqual(conf.get('dfw', 'x'), 'a')
+        self.assertEqual(conf.get('dfw', 'user'), 'home')
+
+    def test_include(self):
+        self.write('.hubblerc', u"%include teams/*.ini\n[hubble]\n"
+                                u"user=home\n[dfw]\nregion=dfw\n")
+        os.mkdir(os.path.join(self.dir, 'teams'))
+        self.write('teams/ops.ini', u"%include = ../.hubblerc\n"
+                                    u"[dfw]\nregion=ops\nteam=ops\n")
+        conf = self.read()
+        # The including file wins and the include cycle is read once
+        self.assertEqual(conf.get('dfw', 'region'), 'dfw')
+        self.assertEqual(conf.get('dfw', 'team'), 'ops')
+
+        # A new file matching the pattern is noticed
+        self.write('teams/dev.ini', u"[ord]\nregion=ord\n")
+        self.assertEqual(self.read().get('ord', 'region'), 'ord')
+
+    def test_only_changed_fragments_are_parsed(self):
+        self.write('.hubblerc.d/a.conf', u"[a]\nvalue=1\n")
+        self.write('.hubblerc.d/b.conf', u"[b]\nvalue=1\n")
+        self.read()
+        self.write('.hubblerc.d/b.conf', u"[b]\nvalue=2\n")
+
+        parsed = []
+        parse_fragment = config.parse_fragment
+
+        def spy(path, contents, default_section):
+            parsed.append(os.path.basename(path))
+            return parse_fragment(path, contents, default_section)
+        config.parse_fragment = spy
+        try:
+            conf = self.read()
+        finally:
+            config.parse_fragment = parse_fragment
+        self.assertEqual(parsed, ['b.conf'])
+        self.assertEqual(conf.get('a', 'value'), '1')
+        self.assertEqual(conf.get('b', 'value'), '2')
+
+    def test_without_cache(self):
+        os.environ['HUBBLE_NO_CACHE'] = '1'
+        self.write('.hubblerc', u"%include extra\n[hubble]\n")
+        self.write('extra', u"[dfw]\nregion=extra\n")
+        self.assertEqual(self.read().get('dfw', 'region'), 'extra')
+
+
+class TestSectionIndex(unittest.TestCase):
+    def setUp(self):
+        file = StringIO(
+            u"[hubble]\n"
+            "[hubble-commands]\n"
+            "nova=/usr/bin/nova\n"
+            "[prod]\n"
+            "tags=prod\n"
+            "[prod-dfw]\n"
+            "%inherit=prod\n"
+            "tags=prod, us\n"
+            "[prod-lon]\n"
+            "%inherit=prod\n"
+            "[dev-dfw]\n"
+            "tags=us\n"
+            "[prod-all]\n"
+            "meta=glob:prod-*\n")
+        file.name = "test-config.ini"
+        self.config = config.parse_configs([file], 'hubble')
+
+    def select(self, selector):
+        return self.config.section_index().select(selector)
+
+    def test_index(self):
+        index = self.config.section_index()
+        self.assertEqual(index.names, ['prod', 'prod-dfw', 'prod-lon',
+                                       'dev-dfw'])
+        # prod-lon inherits its tag
+        self.assertEqual(index.tags, {'prod': ['prod', 'prod-dfw',
+                                               'prod-lon'],
+                                      'us': ['prod-dfw', 'dev-dfw']})
+
+    def test_select(self):
+        self.assertEqual(self.select('prod-*'), ['prod-dfw', 'prod-lon'])
+        self.assertEqual(self.select('glob:*-dfw'), ['prod-dfw', 'dev-dfw'])
+        self.assertEqual(self.select('@us'), ['prod-dfw', 'dev-dfw'])
+        self.assertEqual(self.select('@us, prod-*'),
+                         ['prod-dfw', 'dev-dfw', 'prod-lon'])
+        self.assertEqual(self.select('@missing'), [])
+
+    def test_is_selector(self):
+        self.assertTrue(config.is_selector('@prod'))
+        self.assertTrue(config.is_selector('prod-*'))
+        self.assertTrue(config.is_selector('glob:prod'))
+        self.assertFalse(config.is_selector('prod-dfw'))
+
+    def test_changes_invalidate(self):
+        self.assertEqual(self.select('@dev'), [])
+        self.config.set('dev-dfw', 'tags', 'dev')
+        self.assertEqual(self.select('@dev'), ['dev-dfw'])
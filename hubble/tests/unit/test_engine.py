@@ -0,0 +1,88 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import hubble
+
+
+def running(pid):
+    """ Return True if the process is alive and not a zombie """
+    try:
+        with open('/proc/%d/stat' % pid) as fd:
+            return fd.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except IOError:
+        return False
+
+
+class TestEngine(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ['HUBBLE_NO_CACHE'] = '1'
+        self.config = os.path.join(self.dir, 'hubblerc')
+        with open(self.config, 'w') as fd:
+            fd.write("[hubble]\n"
+                     "cmd=sh\n"
+                     "env-cmd=echo REGION=${section}\n"
+                     "[all]\n"
+                     "meta=['dfw', 'ord']\n"
+                     "[dfw]\n"
+                     "[ord]\n")
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def run_async(self, *args, **kwargs):
+        kwargs['files'] = [self.config]
+        return asyncio.run(hubble.run_async(*args, **kwargs))
+
+    def test_run(self):
+        results = self.run_async('all', ['-c', 'echo $REGION; exit 3'])
+        self.assertEqual([(r.section, r.returncode, r.stdout)
+                          for r in results],
+                         [('dfw', 3, b'dfw\n'), ('ord', 3, b'ord\n')])
+
+    def test_stream(self):
+        async def stream():
+            return [result.section async for result in hubble.stream_async(
+                'all', ['-c', 'test $REGION = dfw && sleep 0.5; true'],
+                files=[self.config])]
+        # Results arrive as each command exits
+        self.assertEqual(asyncio.run(stream()), ['ord', 'dfw'])
+
+    def test_timeout(self):
+        result, = self.run_async('dfw', ['-c', 'echo started; sleep 30'],
+                                 timeout=0.2)
+        self.assertTrue(result.timed_out)
+        self.assertEqual(result.stdout, b'started\n')
+
+    def test_cancel(self):
+        pidfile = os.path.join(self.dir, 'pid')
+
+        async def cancel():
+            task = asyncio.ensure_future(hubble.run_async(
+                'dfw', ['-c', 'sleep 30 & echo $! > %s; wait' % pidfile],
+                files=[self.config]))
+            while not os.path.exists(pidfile):
+                await asyncio.sleep(0.05)
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        start = time.time()
+        asyncio.run(cancel())
+        self.assertLess(time.time() - start, 5)
+        with open(pidfile) as fd:
+            pid = int(fd.read())
+        # The command and what it started are gone
+        time.sleep(0.1)
+        self.assertFalse(running(pid))
+
+    def test_errors(self):
+        with self.assertRaises(RuntimeError):
+            self.run_async('nope')
@@ -14,10 +14,17 @@
 
 import argparse
 from io import StringIO
+import os
+import shutil
+import tempfile
+import time
 import unittest
 
+from hubble import keys
 from hubble.config import parse_configs
-from hubble.shell import empty, Env, get_environments, run, to_dict
+from hubble.shell import empty, Env, get_environments, get_spool_size, run
+from hubble.shell import to_dict
+from hubble.tests.unit.test_keys import FakeKeyring
 
 
 class TestEnv(unittest.TestCase):
@@ -30,6 +37,49 @@ class TestEnv(unittest.TestCase):
         self.assertEqual(env['string'].value, "My name is Derrick Wippler")
         self.assertEqual(env['string'].section, "section")
 
+    def test_env_expansion_order(self):
+        env = Env()
+        env.set('url', '${scheme}://${host}${path}', 'section')
+        env.set('host', '${name}.example.com', 'section')
+        env.set('scheme', 'https', 'section')
+        env.set('path', '/v2.0', 'section')
+        env.set('name', 'identity', 'section')
+        env.eval()
+        self.assertEqual(env['url'].value,
+                         'https://identity.example.com/v2.0')
+
+    def test_env_cycle(self):
+        env = Env()
+        env.set('a', '${b}', 'section')
+        env.set('b', '${c}', 'section')
+        env.set('c', '${a}', 'section')
+        with self.assertRaises(RuntimeError) as cm:
+            env.eval()
+        self.assertIn('a -> b -> c -> a', str(cm.exception))
+
+    def test_env_missing(self):
+        env = Env()
+        env.set('a', 'x ${b}', 'section')
+        self.assertRaises(RuntimeError, env.eval)
+
+    def test_env_lazy(self):
+        env = Env()
+        env.set('password', "USE_KEYRING['password']", 'section',
+                export=False)
+        env.set('user', 'thrawn', 'section')
+        fake = FakeKeyring({'__global__:password': 'secret'})
+        backend, keys.keyring = keys.keyring, fake
+        try:
+            env.eval()
+            self.assertEqual(fake.calls, [])
+            env.set('auth', '${user}:${password}', 'section')
+            env.eval()
+            self.assertEqual(fake.calls, ['__global__:password'])
+        finally:
+            keys.keyring = backend
+            keys._passwords.clear()
+        self.assertEqual(env['auth'].value, 'thrawn:secret')
+
     def test_env_to_dict(self):
         env = Env()
         env.set('first', 'Derrick', 'section')
@@ -38,6 +88,32 @@ class TestEnv(unittest.TestCase):
         expected = {'first': 'Derrick', 'last': 'Wippler'}
         self.assertEqual(env.to_dict(), expected)
 
+    def test_env_layers(self):
+        shared = Env()
+        shared.add({'url': 'https://${section}.example.com',
+                    'user': 'thrawn', 'OS_PASSWORD': 'USE_KEYRING'})
+        dfw = Env(shared)
+        dfw.add({'section': 'dfw'}, 'dfw')
+        self.assertEqual(dfw.keyring_refs(), [('dfw', 'OS_PASSWORD')])
+        dfw.delete('OS_PASSWORD')
+        dfw.eval()
+        iad = Env(shared)
+        iad.add({'section': 'iad'}, 'iad')
+        iad.delete('user')
+        iad.delete('OS_PASSWORD')
+        iad.eval()
+
+        self.assertEqual(dfw['url'].value, 'https://dfw.example.com')
+        self.assertEqual(dfw['url'].section, 'dfw')
+        self.assertEqual(iad['url'].value, 'https://iad.example.com')
+        self.assertNotIn('user', iad)
+        self.assertEqual(dfw.to_dict(), {'section': 'dfw', 'user': 'thrawn',
+                                         'url': 'https://dfw.example.com'})
+        # Only what changed was copied, the shared layer is untouched
+        self.assertEqual(sorted(dfw.layer), ['OS_PASSWORD', 'section', 'url'])
+        self.assertEqual(shared['url'].value, 'https://${section}.example.com')
+        self.assertIn('user', shared)
+
     def test_get_environments(self):
         parser = argparse.ArgumentParser()
         parser.add_argument('env')
@@ -62,6 +138,156 @@ class TestEnv(unittest.TestCase):
         self.assertIn('FIRST', env[0])
         self.assertIn('last', env[0])
 
+    def get_meta_environments(self, config):
+        parser = argparse.ArgumentParser()
+        parser.add_argument('env')
+        args = parser.parse_args(['all'])
+        file = StringIO(config)
+        file.name = "test-config.ini"
+        config = parse_configs([file], default_section='hubble')
+        return get_environments(args, 'all', config)
+
+    def test_get_environments_meta_overrides_defaults(self):
+        envs = self.get_meta_environments(
+            u"[hubble]\n"
+            "cmd=nova\n"
+            "[all]\n"
+            "meta=['dfw', 'ord']\n"
+            "cmd=cinder\n"
+            "[dfw]\n"
+            "[ord]\n"
+            "cmd=swift\n")
+        self.assertEqual([env['cmd'].value for env in envs],
+                         ['cinder', 'swift'])
+
+    def test_nested_meta(self):
+        envs = self.get_meta_environments(
+            u"[all]\n"
+            "meta=us\n"
+            "    lon\n"
+            "[us]\n"
+            "meta=['dfw', 'ord', 'dfw']\n"
+            "[other]\n"
+            "meta=['ord', 'iad']\n"
+            "[dfw]\n[ord]\n[lon]\n[iad]\n")
+        # Each section runs once, where it first appears
+        self.assertEqual([env['section'].value for env in envs],
+                         ['dfw', 'ord', 'lon'])
+        envs = self.get_meta_environments(
+            u"[all]\n"
+            "meta=us\n"
+            "     other\n"
+            "[us]\n"
+            "meta=['dfw', 'ord']\n"
+            "[other]\n"
+            "meta=['ord', 'iad']\n"
+            "[dfw]\n[ord]\n[iad]\n")
+        self.assertEqual([env['section'].value for env in envs],
+                         ['dfw', 'ord', 'iad'])
+
+    def test_meta_errors(self):
+        for meta, error in (
+                ("['us']\n[us]\nmeta=['dfw', 'all']", 'all -> us -> all'),
+                ("['dfw', 'nope']", '[nope] which does not exist'),
+                ("__import__('os').getcwd()", '[__import__(\'os\')'),
+                ("['dfw', 1]", 'must be a list of section names'),
+                ("[]", 'has no sections to run')):
+            with self.assertRaises(RuntimeError) as cm:
+                self.get_meta_environments(u"[all]\nmeta=%s\n[dfw]\n"
+                                           % meta)
+            self.assertIn(error, str(cm.exception))
+
+    def test_get_environments_concurrently(self):
+        start = time.time()
+        envs = self.get_meta_environments(
+            u"[all]\n"
+            "meta=['dfw', 'ord', 'lon', 'iad']\n"
+            "env-cmd=sleep 0.3; echo REGION=${section}\n"
+            "[dfw]\n[ord]\n[lon]\n[iad]\n")
+        self.assertLess(time.time() - start, 1.2)
+        self.assertEqual([env['REGION'].value for env in envs],
+                         ['dfw', 'ord', 'lon', 'iad'])
+
+    def test_get_environments_errors(self):
+        with self.assertRaises(RuntimeError) as cm:
+            self.get_meta_environments(
+                u"[all]\n"
+                "meta=['dfw', 'ord', 'lon']\n"
+                "env-cmd=echo A=1\n"
+                "[dfw]\n"
+                "[ord]\n"
+                "env-cmd=exit 1\n"
+                "[lon]\n"
+                "OPTION=${missing}\n")
+        message = str(cm.exception)
+        self.assertNotIn('[dfw]', message)
+        self.assertIn('unable to resolve [ord]', message)
+        self.assertIn('unable to resolve [lon]', message)
+
+    def test_get_environments_selectors(self):
+        file = StringIO(u"[hubble]\n"
+                        "[dfw]\n"
+                        "tags=us\n"
+                        "[ord]\n"
+                        "tags=us\n"
+                        "[lon]\n"
+                        "[us]\n"
+                        "meta=@us\n")
+        file.name = "test-config.ini"
+        config = parse_configs([file], default_section='hubble')
+        args = argparse.Namespace(env='x')
+
+        def sections(choice):
+            return [env['section'].value
+                    for env in get_environments(args, choice, config)]
+        self.assertEqual(sections('@us'), ['dfw', 'ord'])
+        self.assertEqual(sections('us'), ['dfw', 'ord'])
+        self.assertEqual(sections('[ol]*'), ['ord', 'lon'])
+        self.assertRaises(RuntimeError, sections, 'iad-*')
+
+
+class TestCommandCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ['HUBBLE_CACHE_DIR'] = self.dir
+        self.counter = os.path.join(self.dir, 'counter')
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def resolve(self, refresh=False, ttl='60'):
+        args = argparse.Namespace(refresh=refresh)
+        file = StringIO(u"[dfw]\n"
+                        "env-cmd=echo x >> %s; echo TOKEN=abc\n"
+                        "env-cmd-ttl=%s\n" % (self.counter, ttl))
+        file.name = "test-config.ini"
+        config = parse_configs([file], default_section='hubble')
+        env = get_environments(args, 'dfw', config)[0]
+        self.assertEqual(env['TOKEN'].value, 'abc')
+        with open(self.counter) as fd:
+            return len(fd.readlines())
+
+    def test_cached(self):
+        self.assertEqual(self.resolve(), 1)
+        self.assertEqual(self.resolve(), 1)
+        self.assertEqual(self.resolve(refresh=True), 2)
+        self.assertEqual(self.resolve(), 2)
+
+    def test_not_cached_without_ttl(self):
+        self.assertEqual(self.resolve(ttl=''), 1)
+        self.assertEqual(self.resolve(ttl=''), 2)
+
+    def test_permissions(self):
+        self.resolve()
+        cmd_dir = os.path.join(self.dir, 'cmd')
+        self.assertEqual(os.stat(cmd_dir).st_mode & 0o077, 0)
+        for name in os.listdir(cmd_dir):
+            mode = os.stat(os.path.join(cmd_dir, name)).st_mode
+            self.assertEqual(mode & 0o077, 0)
+
 
 class TestHubble(unittest.TestCase):
     def test_empty(self):
@@ -79,3 +305,15 @@ class TestHubble(unittest.TestCase):
         env = run('echo "USER=thrawn\nSHELL=bash"', Env())
         self.assertIn('USER', env)
         self.assertIn('SHELL', env)
+
+    def test_spool_size(self):
+        def spool_size(value):
+            file = StringIO(u"[hubble]\nspool-size=%s\n" % value)
+            file.name = "test-config.ini"
+            return get_spool_size(parse_configs([file],
+                                                default_section='hubble'))
+        self.assertEqual(spool_size('1000'), 1000)
+        self.assertEqual(spool_size('64k'), 64 * 1024)
+        self.assertEqual(spool_size('2M'), 2 * 1024 * 1024)
+        self.assertEqual(spool_size(''), 1024 * 1024)
+        self.assertRaises(RuntimeError, spool_size, 'lots')
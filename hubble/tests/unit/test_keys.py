@@ -0,0 +1,91 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from hubble import keys
+from hubble.shell import Env
+
+
+class FakeKeyring(object):
+    def __init__(self, passwords):
+        self.passwords = passwords
+        self.calls = []
+
+    def get_password(self, service, key):
+        self.calls.append(key)
+        return self.passwords.get(key)
+
+
+class TestKeys(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ['XDG_RUNTIME_DIR'] = self.dir
+        self.keyring = keys.keyring
+        keys.keyring = FakeKeyring({'__global__:api-key': 'secret',
+                                    'dfw:OS_PASSWORD': 'dfw-secret'})
+        keys._passwords.clear()
+
+    def tearDown(self):
+        keys.keyring = self.keyring
+        keys._passwords.clear()
+        keys.use_session_cache(0)
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def test_lookups_are_deduplicated(self):
+        for _ in range(3):
+            self.assertEqual(keys.get_password('api-key', None), 'secret')
+        self.assertEqual(keys.keyring.calls, ['__global__:api-key'])
+        self.assertRaises(RuntimeError, keys.get_password, 'missing', None)
+
+    def test_prefetch(self):
+        keys.prefetch([('api-key', None), ('dfw', 'OS_PASSWORD'),
+                       ('api-key', None)])
+        self.assertEqual(keys.get_password('dfw', 'OS_PASSWORD'),
+                         'dfw-secret')
+        self.assertEqual(sorted(keys.keyring.calls),
+                         ['__global__:api-key', 'dfw:OS_PASSWORD'])
+
+    def test_session_cache(self):
+        keys.use_session_cache(60)
+        keys.prefetch([('api-key', None)])
+        path = keys.session.path
+        self.assertEqual(os.stat(path).st_mode & 0o077, 0)
+
+        # A new invocation finds the credential in the session cache
+        keys._passwords.clear()
+        keys.use_session_cache(60)
+        self.assertEqual(keys.get_password('api-key', None), 'secret')
+        self.assertEqual(keys.keyring.calls, ['__global__:api-key'])
+
+    def test_expired_entries_leave_the_file(self):
+        path = keys.session_path()
+        keys.SessionCache(60).update({'old': 'one', 'new': 'two'})
+        with open(path) as fd:
+            entries = json.load(fd)
+        entries['old'][0] = time.time() - 1
+        with open(path, 'w') as fd:
+            json.dump(entries, fd)
+
+        self.assertIsNone(keys.SessionCache(60).get('old'))
+        with open(path) as fd:
+            self.assertEqual(sorted(json.load(fd)), ['new'])
+
+        entries['new'][0] = time.time() - 1
+        with open(path, 'w') as fd:
+            json.dump({'new': entries['new']}, fd)
+        self.assertIsNone(keys.SessionCache(60).get('new'))
+        self.assertFalse(os.path.exists(path))
+
+    def test_keyring_refs(self):
+        env = Env()
+        env.set('OS_PASSWORD', 'USE_KEYRING', 'dfw')
+        env.set('KEY', "USE_KEYRING['api-key']", 'dfw')
+        env.set('OTHER', "USE_KEYRING['other']", 'dfw', export=False)
+        self.assertEqual(sorted(env.keyring_refs(), key=str),
+                         [('api-key', None), ('dfw', 'OS_PASSWORD')])
@@ -0,0 +1,247 @@
+from io import StringIO
+import json
+import os
+import shutil
+import signal
+from subprocess import PIPE, Popen
+import sys
+import tempfile
+import time
+import unittest
+
+from hubble import output
+from hubble.output import Multiplexer, OutputCache, Replay, Spool
+
+
+def spawn(code):
+    return Popen([sys.executable, '-c', code], stdout=PIPE, stderr=PIPE)
+
+
+class TestMultiplexer(unittest.TestCase):
+    def setUp(self):
+        self.stdout = StringIO()
+        self.stderr = StringIO()
+
+    def test_passthrough(self):
+        mux = Multiplexer(self.stdout, self.stderr)
+        mux.add('dfw', spawn("import sys; sys.stdout.write('out');"
+                             "sys.stderr.write('err'); sys.exit(3)"))
+        self.assertEqual(mux.run(), [('dfw', 3)])
+        self.assertEqual(self.stdout.getvalue(), 'out')
+        self.assertEqual(self.stderr.getvalue(), 'err')
+
+    def test_prefix(self):
+        mux = Multiplexer(self.stdout, self.stderr, prefix=True)
+        mux.add('dfw', spawn("print('one'); print('two')"))
+        mux.add('ord', spawn("print('three')"))
+        mux.run()
+        lines = self.stdout.getvalue().splitlines()
+        self.assertEqual(sorted(lines),
+                         ['[dfw] one', '[dfw] two', '[ord] three'])
+
+    def test_headers(self):
+        mux = Multiplexer(self.stdout, self.stderr, headers=True)
+        mux.add('dfw', spawn("print('one')"))
+        mux.run()
+        self.assertEqual(self.stdout.getvalue(),
+                         "-- [\033[92mdfw\033[0m] --\none\n")
+
+    def test_headers_keep_order(self):
+        mux = Multiplexer(self.stdout, self.stderr, headers=True)
+        mux.add('dfw', spawn("import time; time.sleep(0.2); print('one')"))
+        mux.add('ord', spawn("print('two')"))
+        mux.add('lon', spawn("pass"))
+        self.assertEqual(mux.run(), [('dfw', 0), ('ord', 0), ('lon', 0)])
+        self.assertEqual(self.stdout.getvalue(),
+                         "-- [\033[92mdfw\033[0m] --\none\n"
+                         "-- [\033[92mord\033[0m] --\ntwo\n"
+                         "-- [\033[92mlon\033[0m] --\n")
+
+    def test_partial_line_is_bounded(self):
+        mux = Multiplexer(self.stdout, self.stderr, prefix=True,
+                          chunk_size=4)
+        mux.add('dfw', spawn("import sys; sys.stdout.write('a' * 10)"))
+        mux.run()
+        self.assertEqual(self.stdout.getvalue().replace('[dfw] ', ''),
+                         'a' * 10 + '\n')
+
+    def test_records(self):
+        mux = Multiplexer(self.stdout, self.stderr, headers=True,
+                          records=True)
+        mux.add('dfw', spawn("import sys, time; time.sleep(0.2);"
+                             "print('one'); sys.exit(2)"))
+        mux.add('ord', spawn("import sys; sys.stderr.write('two')"))
+        self.assertEqual(mux.run(), [('dfw', 2), ('ord', 0)])
+        self.assertEqual(self.stderr.getvalue(), '')
+        records = [json.loads(line)
+                   for line in self.stdout.getvalue().splitlines()]
+        # Records are written as each section finishes
+        self.assertEqual([(r['section'], r['returncode'], r['stdout'],
+                           r['stderr']) for r in records],
+                         [('ord', 0, '', 'two'), ('dfw', 2, 'one\n', '')])
+        self.assertEqual(records[1]['command'][0], sys.executable)
+        self.assertGreaterEqual(records[1]['duration'], 0.2)
+        self.assertAlmostEqual(records[1]['end'] - records[1]['start'],
+                               records[1]['duration'])
+
+    def test_records_spill(self):
+        mux = Multiplexer(self.stdout, self.stderr, records=True,
+                          spool_size=10)
+        mux.add('dfw', spawn("print('a' * 20)"))
+        mux.run()
+        record = json.loads(self.stdout.getvalue())
+        self.assertNotIn('stdout', record)
+        self.assertEqual(record['stderr'], '')
+        try:
+            with open(record['stdout_path']) as fd:
+                self.assertEqual(fd.read(), 'a' * 20 + '\n')
+        finally:
+            shutil.rmtree(os.path.dirname(record['stdout_path']))
+
+    def test_timeout_kills_process_group(self):
+        mux = Multiplexer(self.stdout, self.stderr)
+        # The grandchild holds the pipes open, so unless the whole
+        # group goes we would wait for it
+        p = Popen(['sh', '-c', 'sleep 30 & wait'], stdout=PIPE, stderr=PIPE,
+                  preexec_fn=os.setpgrp)
+        start = time.time()
+        mux.add('dfw', p, timeout=0.2)
+        self.assertEqual(mux.run(), [('dfw', -signal.SIGTERM)])
+        self.assertLess(time.time() - start, 5)
+        self.assertTrue(mux.sections[0].timed_out)
+        self.assertEqual(self.stderr.getvalue(), '-- [dfw] timed out\n')
+
+    def test_kill_after_grace(self):
+        grace, output.KILL_GRACE = output.KILL_GRACE, 0.2
+        try:
+            mux = Multiplexer(self.stdout, self.stderr)
+            mux.add('dfw', spawn("import signal, sys, time;"
+                                 "signal.signal(signal.SIGTERM,"
+                                 " signal.SIG_IGN);"
+                                 "print('ready'); sys.stdout.flush();"
+                                 "time.sleep(30)"), timeout=0.5)
+            self.assertEqual(mux.run(), [('dfw', -signal.SIGKILL)])
+        finally:
+            output.KILL_GRACE = grace
+
+
+class TestBinaryOutput(unittest.TestCase):
+    """ Output to targets with a file descriptor is copied as raw bytes """
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.stdout = open(os.path.join(self.dir, 'stdout'), 'w')
+        self.stderr = open(os.path.join(self.dir, 'stderr'), 'w')
+
+    def tearDown(self):
+        self.stdout.close()
+        self.stderr.close()
+        shutil.rmtree(self.dir)
+
+    def output(self):
+        self.stdout.flush()
+        with open(self.stdout.name, 'rb') as fd:
+            return fd.read()
+
+    def binary(self, size):
+        return spawn("import sys; out = getattr(sys.stdout, 'buffer', "
+                     "sys.stdout); out.write((b'\\xff\\xfe\\x00\\n' + "
+                     "bytes(bytearray(range(128, 189)))) * %d)" % size)
+
+    def test_passthrough(self):
+        mux = Multiplexer(self.stdout, self.stderr)
+        mux.add('dfw', spawn("import sys; out = getattr(sys.stdout, "
+                             "'buffer', sys.stdout); out.write(b'\\xff'"
+                             " * 100000)"))
+        mux.run()
+        self.assertEqual(self.output(), b'\xff' * 100000)
+
+    def test_headers_spool_to_disk(self):
+        mux = Multiplexer(self.stdout, self.stderr, headers=True,
+                          spool_size=1024)
+        mux.add('dfw', spawn("import time; time.sleep(0.2); print('one')"))
+        mux.add('ord', self.binary(1000))
+        mux.run()
+        start = (b"-- [\033[92mdfw\033[0m] --\none\n"
+                 b"-- [\033[92mord\033[0m] --\n")
+        self.assertEqual(self.output(), start + (
+            b'\xff\xfe\x00\n' + bytes(bytearray(range(128, 189)))) * 1000)
+
+    def test_prefix(self):
+        mux = Multiplexer(self.stdout, self.stderr, prefix=True)
+        mux.add('dfw', spawn("import sys; out = getattr(sys.stdout, "
+                             "'buffer', sys.stdout); out.write(b'\\xff\\n"
+                             "two\\n')"))
+        mux.run()
+        self.assertEqual(self.output(), b'[dfw] \xff\n[dfw] two\n')
+
+
+class TestOutputCache(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'output', 'dfw.pickle')
+        self.stdout = StringIO()
+        self.stderr = StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_capture_and_replay(self):
+        mux = Multiplexer(self.stdout, self.stderr)
+        mux.add('dfw', spawn("import sys; sys.stdout.write('out');"
+                             "sys.stderr.write('err')"),
+                output_cache=OutputCache(self.path, 60))
+        mux.run()
+        self.assertEqual(oct(os.stat(self.path).st_mode & 0o777), oct(0o600))
+        replay = OutputCache(self.path, 60).load()
+        self.assertEqual((replay.returncode, replay.stdout, replay.stderr),
+                         (0, b'out', b'err'))
+
+        stdout = StringIO()
+        mux = Multiplexer(stdout, StringIO(), records=True)
+        section = mux.add('dfw', replay)
+        self.assertTrue(section.closed)
+        record = json.loads(stdout.getvalue())
+        self.assertEqual((record['stdout'], record['stderr'],
+                          record['cached']), ('out', 'err', True))
+        self.assertEqual(mux.results(), [('dfw', 0)])
+
+    def test_only_success_is_cached(self):
+        mux = Multiplexer(self.stdout, self.stderr, spool_size=10)
+        mux.add('dfw', spawn("import sys; print('out'); sys.exit(1)"),
+                output_cache=OutputCache(self.path, 60))
+        mux.add('ord', spawn("print('a' * 20)"),
+                output_cache=OutputCache(self.path, 60))
+        mux.run()
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_expired(self):
+        os.makedirs(os.path.dirname(self.path), 0o700)
+        output = OutputCache(self.path, 60)
+        mux = Multiplexer(self.stdout, self.stderr)
+        mux.add('dfw', Replay(['ls'], 0, b'one\n', b''))
+        self.assertEqual(self.stdout.getvalue(), 'one\n')
+        from hubble import cache
+        cache.save(self.path, (time.time() - 1, ['ls'], 0, b'', b''))
+        self.assertIsNone(output.load())
+
+
+class TestSpool(unittest.TestCase):
+    def test_memory(self):
+        spool = Spool(10)
+        spool.write(b'abc')
+        spool.write(b'def')
+        self.assertIsNone(spool.file)
+        self.assertEqual(b''.join(spool.chunks()), b'abcdef')
+
+    def test_disk(self):
+        spool = Spool(4)
+        spool.write(b'abc')
+        spool.write(b'def')
+        self.assertIsNotNone(spool.file)
+        self.assertEqual(b''.join(spool.chunks()), b'abcdef')
+        r, w = os.pipe()
+        spool.copy(w)
+        os.close(w)
+        self.assertEqual(os.read(r, 100), b'abcdef')
+        os.close(r)
+        spool.close()
@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import hubble
+
+
+class TestResolver(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.environ = os.environ.copy()
+        os.environ['HUBBLE_NO_CACHE'] = '1'
+        self.counter = os.path.join(self.dir, 'counter')
+        self.config = os.path.join(self.dir, 'hubblerc')
+        self.write("[hubble]\n"
+                   "URL=https://${section}.example.com\n"
+                   "opt-cmd=echo OPTION=${opt.option}\n"
+                   "env-cmd=echo run >> %s; echo REGION=${section}\n"
+                   "[all]\n"
+                   "meta=['dfw', 'ord']\n"
+                   "[dfw]\n"
+                   "[ord]\n" % self.counter)
+        self.resolver = hubble.Resolver(files=[self.config])
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.dir)
+
+    def write(self, config_string):
+        with open(self.config, 'w') as fd:
+            fd.write(config_string)
+
+    def runs(self):
+        with open(self.counter) as fd:
+            return len(fd.read().split())
+
+    def test_no_lazy_import(self):
+        # Module __getattr__ needs python 3.7, Resolver must not
+        self.assertIn('Resolver', vars(hubble))
+
+    def test_resolve(self):
+        env = self.resolver.resolve('dfw', option='thrawn')
+        self.assertEqual(env['URL'], 'https://dfw.example.com')
+        self.assertEqual(env['REGION'], 'dfw')
+        self.assertEqual(env['OPTION'], 'thrawn')
+        self.assertEqual(env['section'], 'dfw')
+
+        # Resolved once, and what we hand out is a copy
+        env['URL'] = 'changed'
+        self.assertEqual(self.resolver.resolve('dfw', option='thrawn')['URL'],
+                         'https://dfw.example.com')
+        self.assertEqual(self.runs(), 1)
+
+    def test_resolve_all(self):
+        envs = self.resolver.resolve_all('all')
+        self.assertEqual([env['REGION'] for env in envs], ['dfw', 'ord'])
+        with self.assertRaises(RuntimeError):
+            self.resolver.resolve('all')
+        with self.assertRaises(RuntimeError):
+            self.resolver.resolve('nope')
+
+    def test_invalidate(self):
+        self.resolver.resolve('dfw')
+        self.resolver.resolve('ord')
+        self.resolver.invalidate('dfw')
+        self.resolver.resolve('dfw')
+        self.resolver.resolve('ord')
+        self.assertEqual(self.runs(), 3)
+
+        # The config is only read again once everything is invalidated
+        self.write("[dfw]\nURL=new\n")
+        self.assertEqual(self.resolver.resolve('dfw')['URL'],
+                         'https://dfw.example.com')
+        self.resolver.invalidate()
+        self.assertEqual(self.resolver.resolve('dfw')['URL'], 'new')
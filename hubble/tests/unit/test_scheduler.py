@@ -0,0 +1,47 @@
+from io import StringIO
+import signal
+import time
+import unittest
+
+from hubble.output import Multiplexer
+from hubble.scheduler import Scheduler
+from hubble.tests.unit.test_output import spawn
+
+
+class TestScheduler(unittest.TestCase):
+    def setUp(self):
+        self.stdout = StringIO()
+        self.mux = Multiplexer(self.stdout, StringIO(), prefix=True)
+        self.running = []
+
+    def job(self, name):
+        def start():
+            self.running.append(
+                len([s for s in self.mux.sections if not s.closed]))
+            return spawn("print('%s')" % name)
+        return name, start, None, None
+
+    def test_parallel(self):
+        jobs = [self.job(name) for name in ('dfw', 'ord', 'lon', 'iad')]
+        results = Scheduler(self.mux, parallel=2).run(jobs)
+        self.assertEqual([name for name, _ in results],
+                         ['dfw', 'ord', 'lon', 'iad'])
+        self.assertEqual(max(self.running), 1)
+        self.assertEqual(len(self.stdout.getvalue().splitlines()), 4)
+
+    def test_no_limit(self):
+        jobs = [self.job(name) for name in ('dfw', 'ord', 'lon')]
+        Scheduler(self.mux).run(jobs)
+        self.assertEqual(self.running, [0, 1, 2])
+
+    def test_fail_fast(self):
+        jobs = [('dfw', lambda: spawn("import time; time.sleep(30)"), None,
+                 None),
+                ('ord', lambda: spawn("import sys; sys.exit(2)"), None, None),
+                self.job('lon')]
+        start = time.time()
+        results = Scheduler(self.mux, parallel=2, fail_fast=True).run(jobs)
+        self.assertLess(time.time() - start, 5)
+        # lon never started
+        self.assertEqual(results, [('dfw', -signal.SIGTERM), ('ord', 2)])
+        self.assertTrue(self.mux.sections[0].cancelled)
@@ -0,0 +1,31 @@
+import os
+from subprocess import check_output
+import sys
+import unittest
+
+import hubble
+
+
+class TestStartup(unittest.TestCase):
+    def test_heavy_modules_are_lazy(self):
+        environ = dict(os.environ,
+                       PYTHONPATH=os.path.dirname(hubble.__path__[0]))
+        out = check_output([sys.executable, '-c', 'import sys, hubble.shell;'
+                            'print("\\n".join(sys.modules))'], env=environ)
+        modules = set(out.decode('utf-8').split())
+        for module in ('keyring', 'concurrent.futures', 'tempfile', 'json',
+                       'hubble.output', 'hubble.scheduler', 'asyncio',
+                       'hubble.engine'):
+            self.assertNotIn(module, modules)
+
+    def test_package_is_light(self):
+        # hubble-keyring and the config only need what they use
+        environ = dict(os.environ,
+                       PYTHONPATH=os.path.dirname(hubble.__path__[0]))
+        out = check_output([sys.executable, '-c', 'import sys, hubble.config;'
+                            'print("\\n".join(sys.modules))'], env=environ)
+        modules = set(out.decode('utf-8').split())
+        self.assertIn('hubble.resolver', modules)
+        for module in ('hubble.shell', 'hubble.agent', 'hubble.keys',
+                       'hubble.timings'):
+            self.assertNotIn(module, modules)
@@ -0,0 +1,94 @@
+from io import StringIO
+import json
+import os
+import shutil
+from subprocess import PIPE, Popen
+import sys
+import tempfile
+import unittest
+
+from hubble.output import Multiplexer
+from hubble.timings import parse_spec, Timings, timings
+
+
+class TestTimings(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        timings.disable()
+
+    def test_disabled(self):
+        recorder = Timings()
+        with recorder.span('resolve', 'dfw'):
+            pass
+        self.assertEqual(recorder.spans, [])
+
+    def test_span(self):
+        recorder = Timings()
+        recorder.enable()
+        with recorder.span('resolve', 'dfw'):
+            pass
+        span, = recorder.spans
+        self.assertEqual((span.name, span.section), ('resolve', 'dfw'))
+        self.assertTrue(span.end >= span.start >= 0)
+
+    def test_report(self):
+        recorder = Timings()
+        recorder.enable()
+        recorder.add('read_configs', None, 0, 0.5)
+        recorder.add('child', 'dfw', 0.5, 1.0, returncode=0, user=0.1,
+                     system=0.2, maxrss_kb=1024)
+
+        stderr = StringIO()
+        recorder.report('table', stderr)
+        lines = stderr.getvalue().splitlines()
+        self.assertEqual(lines[2].split(), ['read_configs', '-', '0.0',
+                                            '500.0'])
+        self.assertEqual(lines[3].split(), ['child', 'dfw', '500.0', '500.0',
+                                            '100.0', '200.0', '1024'])
+
+        path = os.path.join(self.tmp, 'timings.json')
+        recorder.report('json:' + path, stderr)
+        with open(path) as fd:
+            spans = json.load(fd)
+        self.assertEqual(spans[1]['maxrss_kb'], 1024)
+
+        path = os.path.join(self.tmp, 'trace.json')
+        recorder.report('trace:' + path, stderr)
+        with open(path) as fd:
+            events = json.load(fd)['traceEvents']
+        self.assertEqual([(e['name'], e['ts'], e['dur']) for e in events],
+                         [('read_configs', 0, 500000),
+                          ('child', 500000, 500000)])
+
+    def test_parse_spec(self):
+        self.assertEqual(parse_spec(None), None)
+        self.assertEqual(parse_spec('0'), None)
+        self.assertEqual(parse_spec('1'), 'table')
+        self.assertEqual(parse_spec('json:/tmp/t'), 'json:/tmp/t')
+        for spec in ('json', 'bogus', 'table:/tmp/t',
+                     'trace:/nonexistent/t.json'):
+            self.assertRaises(RuntimeError, parse_spec, spec)
+
+    def test_report_unwritable(self):
+        recorder = Timings()
+        recorder.enable()
+        stderr = StringIO()
+        # A directory can't be written as a file
+        recorder.report('json:' + self.tmp, stderr)
+        self.assertEqual(stderr.getvalue().split(' - ')[0],
+                         "-- unable to write timings to '%s'" % self.tmp)
+
+    def test_child_rusage(self):
+        timings.enable()
+        mux = Multiplexer(StringIO(), StringIO())
+        mux.add('dfw', Popen([sys.executable, '-c', 'import sys; '
+                              'sys.exit(3)'], stdout=PIPE, stderr=PIPE))
+        self.assertEqual(mux.run(), [('dfw', 3)])
+        span, = timings.spans
+        self.assertEqual((span.name, span.section), ('child', 'dfw'))
+        self.assertEqual(span.extra['returncode'], 3)
+        if hasattr(os, 'wait4'):
+            self.assertTrue(span.extra['maxrss_kb'] > 0)
@@ -0,0 +1,173 @@
+#   Copyright 2014 Derrick J. Wippler
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+
+from contextlib import contextmanager
+import os
+import sys
+import threading
+import time
+
+clock = getattr(time, 'monotonic', time.time)
+
+
+class Span(object):
+    """ A phase of the run, times are seconds since the recorder started """
+    def __init__(self, name, section, start, end, thread, **extra):
+        self.name = name
+        self.section = section
+        self.start = start
+        self.end = end
+        self.thread = thread
+        self.extra = extra
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+    def to_dict(self):
+        d = dict(name=self.name, section=self.section, start=self.start,
+                 end=self.end, duration=self.duration)
+        d.update(self.extra)
+        return d
+
+
+class Timings(object):
+    """
+    Records how long each phase of a run takes. Does nothing until
+    enable() is called, so the instrumentation costs next to nothing
+    when no one is looking
+    """
+    def __init__(self):
+        self.enabled = False
+        self.spans = []
+        self.origin = clock()
+        self.lock = threading.Lock()
+
+    def enable(self, origin=None):
+        """ Start recording, 'origin' is the clock() the run started at """
+        self.enabled = True
+        self.spans = []
+        self.origin = clock() if origin is None else origin
+
+    def disable(self):
+        self.enabled = False
+
+    def now(self):
+        return clock() - self.origin
+
+    def add(self, name, section, start, end, **extra):
+        if not self.enabled:
+            return
+        span = Span(name, section, start, end, threading.current_thread().name,
+                    **extra)
+        with self.lock:
+            self.spans.append(span)
+
+    @contextmanager
+    def span(self, name, section=None, **extra):
+        """ Record the time spent in the with block """
+        if not self.enabled:
+            yield
+            return
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add(name, section, start, self.now(), **extra)
+
+    def add_child(self, section, start, returncode, rusage):
+        """ Record a child process that exited with the rusage given """
+        if not self.enabled:
+            return
+        extra = {'returncode': returncode}
+        if rusage is not None:
+            # ru_maxrss is in kilobytes everywhere but OS X
+            maxrss = rusage.ru_maxrss
+            if sys.platform == 'darwin':
+                maxrss //= 1024
+            extra.update(user=rusage.ru_utime, system=rusage.ru_stime,
+                         maxrss_kb=maxrss)
+        self.add('child', section, start, self.now(), **extra)
+
+    def table(self, stderr):
+        """ Write a human readable summary of the spans """
+        stderr.write("-- timings (ms) --\n")
+        stderr.write("%-16s %-20s %9s %9s %9s %9s %10s\n"
+                     % ('phase', 'section', 'start', 'duration', 'user',
+                        'system', 'max rss KB'))
+        for span in sorted(self.spans, key=lambda s: s.start):
+            cpu = ('%9.1f %9.1f %10d' % (span.extra['user'] * 1000,
+                                         span.extra['system'] * 1000,
+                                         span.extra['maxrss_kb'])
+                   if 'user' in span.extra else '')
+            row = "%-16s %-20s %9.1f %9.1f %s" % (
+                span.name, span.section or '-', span.start * 1000,
+                span.duration * 1000, cpu)
+            stderr.write(row.rstrip() + "\n")
+
+    def trace(self):
+        """ Return the spans in the Chrome trace event format """
+        threads = {}
+        events = []
+        for span in self.spans:
+            # Give every child process a row of its own
+            key = span.section if span.name == 'child' else span.thread
+            tid = threads.setdefault(key, len(threads) + 1)
+            events.append({'name': span.name, 'cat': 'hubble', 'ph': 'X',
+                           'ts': span.start * 1e6, 'dur': span.duration * 1e6,
+                           'pid': os.getpid(), 'tid': tid,
+                           'args': dict(span.extra, section=span.section)})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def report(self, spec, stderr):
+        """
+        Write the spans as described by 'spec', which is 'table' for a
+        summary on stderr, 'json:PATH' or 'trace:PATH' for a file
+        """
+        import json
+        kind, _, path = spec.partition(':')
+        if kind in ('json', 'trace') and path:
+            data = self.trace() if kind == 'trace' else \
+                [span.to_dict() for span in self.spans]
+            try:
+                with open(path, 'w') as fd:
+                    json.dump(data, fd, indent=2)
+            except EnvironmentError as e:
+                # The command has run, don't lose its exit code
+                stderr.write("-- unable to write timings to '%s' - %s\n"
+                             % (path, e))
+            return
+        self.table(stderr)
+
+
+def parse_spec(spec):
+    """ Return the report spec, or None if 'spec' does not ask for one """
+    if not spec or spec in ('0', 'false', 'no', 'off'):
+        return None
+    if spec in ('1', 'true', 'yes', 'on'):
+        return 'table'
+    kind, _, path = spec.partition(':')
+    if kind == 'table' and not path:
+        return spec
+    if kind in ('json', 'trace') and path:
+        if not os.path.isdir(os.path.dirname(os.path.abspath(path))):
+            raise RuntimeError("unable to write timings to '%s' - no such "
+                               "directory" % path)
+        return spec
+    raise RuntimeError("unknown timings format '%s', expected table, "
+                       "json:PATH or trace:PATH" % spec)
+
+
+# The recorder used by the rest of hubble
+timings = Timings()